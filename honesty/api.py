@@ -1,4 +1,5 @@
 import asyncio
+import os
 import posixpath
 import shutil
 from pathlib import Path
@@ -7,9 +8,11 @@ from typing import Optional, Sequence, Union
 import click
 from packaging.version import Version
 
-from .cache import Cache
+from .cache import BUFFER_SIZE, Cache
 from .releases import FileEntry, FileType, Package, PackageRelease
 
+DEFAULT_CONCURRENCY = 8
+
 
 def download_many(
     package: Package,
@@ -17,13 +20,17 @@ def download_many(
     dest: Path,
     cache: Cache,
     verbose: bool = False,
+    concurrency: int = DEFAULT_CONCURRENCY,
 ) -> int:
     """
     Intended as a convenience method for the CLI.  If you want async duplicate
     this.  Version parsing happens in the layer above in cmdline.py.
     """
-    loop = asyncio.get_event_loop()
-    return loop.run_until_complete(async_download_many(package, versions, dest, cache))
+    return cache.run_sync(
+        async_download_many(
+            package, versions, dest, cache, verbose=verbose, concurrency=concurrency
+        )
+    )
 
 
 async def async_download_many(
@@ -32,11 +39,21 @@ async def async_download_many(
     dest: Optional[Path],
     cache: Cache,
     verbose: bool = False,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    sem: Optional[asyncio.Semaphore] = None,
 ) -> int:
-    # Once aioitertools has a new release, this can use concurency-limited
-    # gather
+    # Only `concurrency` downloads are in flight at once, so asking for many
+    # versions doesn't open a socket per version.  Callers running several of
+    # these at once can pass a shared `sem` to bound them all together.
+    if sem is None:
+        sem = asyncio.Semaphore(concurrency)
+
+    async def _bound(v: Union[Version, str]) -> Path:
+        async with sem:
+            return await async_download_one(package, v, dest, cache)
+
     rc = 0
-    coros = [async_download_one(package, v, dest, cache) for v in versions]
+    coros = [_bound(v) for v in versions]
     for coro in asyncio.as_completed(coros):
         try:
             result = await coro
@@ -64,21 +81,49 @@ async def async_download_one(
     rel = pick_release(package, version)
     sdist = pick_sdist(package.name, rel)
     url = sdist.url
-    cache_path = await cache.async_fetch(package.name, url)
-    # TODO: check hash
+    cache_path = await cache.async_fetch(
+        package.name, url, expected_sha256=sdist.sha256
+    )
     if dest:
         # So that cache can make arbitrary names, we get the basename portion
         # from the url.
         dest_filename = dest / posixpath.basename(url)
-        # In the future, can reflink for additional speedup (pypi:reflink)
-        # try:
-        #     reflink.reflink(cache_path, dest_filename)
-        # except (NotImplementedError, ReflinkImpossibleError) as e:
-        shutil.copyfile(cache_path, dest_filename)
+        _fast_copy(cache_path, dest_filename)
         return dest_filename
     return cache_path
 
 
+def _fast_copy(src: Path, dst: Path) -> None:
+    """
+    Like shutil.copyfile, but lets the kernel do the copy (which can be a
+    reflink on filesystems that support it) when os.copy_file_range exists.
+    """
+    if not hasattr(os, "copy_file_range"):
+        shutil.copyfile(src, dst)
+        return
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+        try:
+            while True:
+                n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), BUFFER_SIZE)
+                if not n:
+                    break
+                copied += n
+        except OSError:
+            # e.g. EXDEV on older kernels, or filesystems that don't implement it
+            copied = -1
+
+        if copied != size:
+            # Some filesystems report EOF early (part of why shutil doesn't use
+            # copy_file_range), so a short copy starts over the slow way.
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst, BUFFER_SIZE)
+
+
 def pick_release(package: Package, version: Version) -> PackageRelease:
     # Only works on conrete versions, no operators
     if version in package.releases:
@@ -99,6 +144,9 @@ def pick_sdist(package_name: str, release: PackageRelease) -> FileEntry:
             pick is None or pick.basename.endswith(".zip")
         ):
             pick = f
+            if not pick.basename.endswith(".zip"):
+                # Nothing later would replace this
+                break
 
     if not pick:
         raise Exception(f"{package_name}=={release.parsed_version} no sdist")
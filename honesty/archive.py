@@ -1,17 +1,59 @@
 import fnmatch
+import functools
 import hashlib
+import io
+import itertools
+import json
+import mmap
 import os
 import os.path
+import re
 import shutil
+import subprocess
+import tarfile
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, Iterable, List, Tuple
+from typing import (
+    Callable,
+    cast,
+    Dict,
+    IO,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
 
 import appdirs
 
+from .cache import atomic_writer, json_loads, recorded_digest
+
 DEFAULT_EXTDIR = os.path.join(
     appdirs.user_cache_dir("honesty", "python-packaging"), "ext"
 )
+DEFAULT_HASHDIR = os.path.join(
+    appdirs.user_cache_dir("honesty", "python-packaging"), "hashes"
+)
+# Extractions are published by renaming them into this subdirectory, so
+# anything there is complete.  Ones directly under the extract dir are from
+# older versions that marked completion with a `.done` file instead, and might
+# be partial, so they're never used.
+EXTRACT_LAYOUT = "v2"
 ZIP_EXTENSIONS = (".zip", ".egg", ".whl")
+TAR_EXTENSIONS = (".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz", ".tar")
+# Files per thread pool task in archive_hashes
+HASH_BATCH_SIZE = 64
+# Part of the name of archive_hashes' remembered results; bump it when which
+# members get hashed (or how) changes, so old results aren't used.
+HASH_MEMO_VERSION = 1
+
+T = TypeVar("T")
 
 
 def extract_and_get_names(
@@ -19,51 +61,498 @@ def extract_and_get_names(
     strip_top_level: bool = False,
     patterns: Iterable[str] = ("*.py",),
 ) -> Tuple[str, List[Tuple[str, str]]]:
-    cache_path = os.path.expanduser(os.environ.get("HONESTY_EXTDIR", DEFAULT_EXTDIR))
+    cache_path = os.path.join(
+        os.path.expanduser(os.environ.get("HONESTY_EXTDIR", DEFAULT_EXTDIR)),
+        EXTRACT_LAYOUT,
+    )
     archive_root = os.path.join(cache_path, archive_filename.name)
-    if not os.path.exists(archive_root + ".done"):
-        format = "zip" if str(archive_filename).endswith(ZIP_EXTENSIONS) else None
-        # mypy-fixme: arg 1 expects str, not Path
-        shutil.unpack_archive(archive_filename.as_posix(), archive_root, format)
-
-    with open(archive_root + ".done", "w"):
-        pass
+    if not os.path.isdir(archive_root):
+        # Extract to the side and rename, so a partial extraction is never
+        # mistaken for a complete one.
+        os.makedirs(cache_path, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=f"{archive_filename.name}.tmp.", dir=cache_path)
+        try:
+            _unpack(archive_filename, tmp)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        try:
+            os.replace(tmp, archive_root)
+        except OSError:
+            # Someone else finished first; theirs is just as good.
+            if not os.path.isdir(archive_root):
+                raise
+            shutil.rmtree(tmp)
 
     # relpath, srcpath
     names: List[Tuple[str, str]] = []
     # TODO figure out the right level of parallelism and/or use cfv
-    for dirpath, dirnames, filenames in os.walk(archive_root):
-        for name in filenames:
-            if not any(fnmatch.fnmatch(name, p) for p in patterns):
-                continue  # skip for now
+    matches = _compile_patterns(tuple(patterns))
+    srckey = _make_srckey(strip_top_level)
+    for entry in _iter_files(archive_root):
+        if not matches(os.path.normcase(entry.name)):
+            continue  # skip for now
 
-            relname = os.path.join(dirpath[len(archive_root) + 1 :], name)
+        relname = entry.path[len(archive_root) + 1 :]
+        names.append((relname, srckey(relname)))
 
-            srckey = relname
-            # To do this right, we need to read setup.py to know how it gets
-            # mapped, but this is an 80% solution.  I'm not 100% sure this does
-            # the right thing on windows.
-            if strip_top_level:
-                srckey = srckey.split(os.sep, 1)[-1]
-            if srckey.startswith("src" + os.sep):
-                srckey = srckey[4:]
+    return (archive_root, names)
 
-            names.append((relname, srckey))
 
-    return (archive_root, names)
+@functools.lru_cache(maxsize=None)
+def _external_tar() -> Optional[Tuple[str, str]]:
+    """
+    Returns (tar, pigz) if both are on PATH.  tar with pigz decompressing in a
+    separate process is several times faster than tarfile and gzip.
+    """
+    tar = shutil.which("tar")
+    gunzip = shutil.which("unpigz") or shutil.which("pigz")
+    if tar and gunzip:
+        return tar, gunzip
+    return None
+
+
+def _unpack(archive_filename: Path, dest: str) -> None:
+    """
+    Extracts archive_filename into the (empty) directory dest, using external
+    tools for .tar.gz when they're available, and shutil otherwise.
+    """
+    external = (
+        _external_tar() if archive_filename.name.endswith((".tar.gz", ".tgz")) else None
+    )
+    if external is not None:
+        tar, gunzip = external
+        try:
+            subprocess.run(
+                [
+                    tar,
+                    f"--use-compress-program={gunzip}",
+                    "--no-same-owner",
+                    "-xf",
+                    archive_filename.as_posix(),
+                    "-C",
+                    dest,
+                ],
+                check=True,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+            return
+        except (OSError, subprocess.CalledProcessError):
+            # tarfile is more forgiving of odd archives; start over with it.
+            shutil.rmtree(dest)
+            os.mkdir(dest)
+
+    format = "zip" if _archive_format(archive_filename) == "zip" else None
+    # mypy-fixme: arg 1 expects str, not Path
+    shutil.unpack_archive(archive_filename.as_posix(), dest, format)
+
+
+def _archive_format(archive_filename: Path) -> Optional[str]:
+    """
+    Returns "zip", "tar", or None if it's neither, going by the name.
+    """
+    # Only the basename matters, and Path keeps that around already.
+    name = archive_filename.name
+    if name.endswith(ZIP_EXTENSIONS):
+        return "zip"
+    elif name.endswith(TAR_EXTENSIONS):
+        return "tar"
+    return None
+
+
+def _make_srckey(strip_top_level: bool) -> Callable[[str], str]:
+    """
+    Returns a function from relname to the name its hash is compared under.
+
+    An sdist has (nearly) everything under one top-level directory, so that
+    prefix is remembered and sliced off rather than splitting every name.
+    """
+    src = "src" + os.sep
+    prefix = ""
+
+    def srckey(relname: str) -> str:
+        nonlocal prefix
+        # To do this right, we need to read setup.py to know how it gets
+        # mapped, but this is an 80% solution.  I'm not 100% sure this does
+        # the right thing on windows.
+        if strip_top_level:
+            if prefix and relname.startswith(prefix):
+                relname = relname[len(prefix) :]
+            else:
+                top, sep, rest = relname.partition(os.sep)
+                if sep:
+                    prefix = top + sep
+                    relname = rest
+        if relname.startswith(src):
+            relname = relname[len(src) :]
+        return relname
+
+    return srckey
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_patterns(patterns: Tuple[str, ...]) -> Callable[[str], bool]:
+    """
+    Returns a function equivalent to `any(fnmatch(name, p) for p in patterns)`
+    for an already-normcased name, but which only compiles the patterns once
+    (and callers mostly pass the same few constant tuples).
+
+    Wildcard-free patterns become a set lookup and simple `*.ext` patterns an
+    endswith check; only what's left goes through a regex.
+    """
+    exact: Set[str] = set()
+    suffixes: List[str] = []
+    remaining: List[str] = []
+    for p in patterns:
+        p = os.path.normcase(p)
+        if not any(c in p for c in "*?["):
+            exact.add(p)
+        elif p.startswith("*") and not any(c in p[1:] for c in "*?["):
+            suffixes.append(p[1:])
+        else:
+            remaining.append(p)
+
+    suffix_tuple = tuple(suffixes)
+    regex = (
+        re.compile("|".join(fnmatch.translate(p) for p in remaining))
+        if remaining
+        else None
+    )
+
+    def matches(name: str) -> bool:
+        return (
+            name in exact
+            or name.endswith(suffix_tuple)
+            or (regex is not None and regex.match(name) is not None)
+        )
+
+    return matches
+
+
+def _iter_files(root: str) -> Iterator["os.DirEntry[str]"]:
+    """
+    Yields non-directory entries under root, like the filenames from
+    `os.walk` but without a separate stat per entry.
+    """
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_dir():
+                # os.walk doesn't descend into symlinked dirs by default either
+                if not entry.is_symlink():
+                    yield from _iter_files(entry.path)
+            else:
+                yield entry
+
+
+def get_hash_dir() -> str:
+    """
+    Where results keyed by archive digest are remembered.
+    """
+    return os.path.expanduser(os.environ.get("HONESTY_HASHDIR", DEFAULT_HASHDIR))
 
 
 # [path] = sha
 def archive_hashes(
-    archive_filename: Path, strip_top_level: bool = False
+    archive_filename: Path,
+    strip_top_level: bool = False,
+    algorithm: str = "sha1",
+    extracted: Optional[Tuple[str, List[Tuple[str, str]]]] = None,
+    archive_sha256: Optional[str] = None,
 ) -> Dict[str, str]:
-    d: Dict[str, str] = {}
-    archive_root, names = extract_and_get_names(archive_filename, strip_top_level)
+    """
+    algorithm is anything hashlib.new accepts; hashes are only comparable to
+    others made with the same one.
 
-    for relname, srcname in names:
-        with open(os.path.join(archive_root, relname), "rb") as buf:
-            data = buf.read().replace(b"\r\n", b"\n")
+    If you've already called extract_and_get_names (with the same
+    strip_top_level), pass its result as extracted to avoid walking again.
+
+    If you know the archive's sha256 (say, from the index), pass it and the
+    result is remembered on disk, so the next time doesn't need to extract or
+    hash anything.  That's only done when archive_filename is known to have
+    that digest (it was recorded when the cache downloaded it); otherwise a
+    damaged or stale file could leave wrong hashes under the right key.
+    """
+    memo_path: Optional[str] = None
+    if archive_sha256 and recorded_digest(archive_filename) == archive_sha256:
+        memo_path = os.path.join(
+            get_hash_dir(),
+            f"{archive_sha256}-{int(strip_top_level)}-{algorithm}"
+            f"-{HASH_MEMO_VERSION}.json",
+        )
+        try:
+            # One entry per member, so this can be big; orjson if it's there
+            memo: Dict[str, str] = json_loads(Path(memo_path).read_bytes())
+            return memo
+        except (OSError, ValueError):
+            pass
+
+    d: Optional[Dict[str, str]] = None
+    if extracted is None:
+        d = _member_hashes(archive_filename, strip_top_level, algorithm)
+        if d is None:
+            extracted = extract_and_get_names(archive_filename, strip_top_level)
+    if extracted is not None:
+        d = _extracted_hashes(extracted, algorithm)
+    assert d is not None
+
+    if memo_path:
+        os.makedirs(os.path.dirname(memo_path), exist_ok=True)
+        with atomic_writer(Path(memo_path)) as f:
+            f.write(json.dumps(d).encode())
 
-        sha = hashlib.sha1(data).hexdigest()
-        d[srcname] = sha
     return d
+
+
+def _extracted_hashes(
+    extracted: Tuple[str, List[Tuple[str, str]]], algorithm: str
+) -> Dict[str, str]:
+    archive_root, names = extracted
+
+    # Both reading and hashing release the GIL, so this does overlap.  Most
+    # files are tiny, so each task is a batch of them to keep the per-task
+    # overhead from dominating.
+    paths = [os.path.join(archive_root, relname) for relname, _ in names]
+    with ThreadPoolExecutor() as pool:
+        shas = itertools.chain.from_iterable(
+            pool.map(
+                functools.partial(_hash_files, algorithm=algorithm), _batches(paths)
+            )
+        )
+        return {srcname: sha for (_, srcname), sha in zip(names, shas)}
+
+
+def _member_hashes(
+    archive_filename: Path,
+    strip_top_level: bool,
+    algorithm: str,
+    patterns: Iterable[str] = ("*.py",),
+) -> Optional[Dict[str, str]]:
+    """
+    Returns the same thing as hashing what extract_and_get_names finds, but
+    reads members straight out of the archive instead of writing them all to
+    disk first.
+
+    Returns None when the archive needs extracting to get the same answer
+    (an unknown format, or a tar with links to follow).
+    """
+    matches = _compile_patterns(tuple(patterns))
+    srckey = _make_srckey(strip_top_level)
+    format = _archive_format(archive_filename)
+    if format == "zip":
+        with open(archive_filename, "rb") as fh, _mapped(fh) as mf:
+            # Passed a file, ZipFile doesn't own it; closing fh is enough.
+            zf = zipfile.ZipFile(mf)
+            members: List[Tuple[str, zipfile.ZipInfo]] = []
+            for zi in zf.infolist():
+                # Most members are rejected by name, so check that first.
+                if not matches(os.path.normcase(zi.filename.rsplit("/", 1)[-1])):
+                    continue
+                relname = _member_relname(zi.filename)
+                if relname is None or zi.is_dir():
+                    continue
+                members.append((srckey(relname), zi))
+
+            def hash_members(batch: List[Tuple[str, zipfile.ZipInfo]]) -> List[str]:
+                shas = []
+                for _, zi in batch:
+                    with zf.open(zi) as f:
+                        shas.append(_hash_stream(f, algorithm=algorithm))
+                return shas
+
+            # ZipFile serializes reads of the underlying file, but inflating
+            # and hashing both happen outside its lock and release the GIL, so
+            # members do get processed in parallel.
+            with ThreadPoolExecutor() as pool:
+                shas = itertools.chain.from_iterable(
+                    pool.map(hash_members, _batches(members))
+                )
+                return {key: sha for (key, _), sha in zip(members, shas)}
+    elif format == "tar":
+        # Stream mode, so this is one sequential pass through the decompressor
+        # (which is also why this one can't be spread across threads).
+        d: Dict[str, str] = {}
+        with tarfile.open(archive_filename, "r|*") as tf:
+            for ti in tf:
+                if not matches(os.path.normcase(ti.name.rsplit("/", 1)[-1])):
+                    continue
+                relname = _member_relname(ti.name)
+                if relname is None or ti.isdir():
+                    continue
+                if not ti.isfile():
+                    # Extracting would follow these; don't guess.
+                    return None
+                f = tf.extractfile(ti)
+                assert f is not None
+                d[srckey(relname)] = _hash_stream(f, algorithm=algorithm)
+        return d
+    return None
+
+
+def iter_members(
+    archive_filename: Path,
+    strip_top_level: bool = False,
+    patterns: Iterable[str] = ("*.py",),
+) -> Iterator[Tuple[str, Callable[[], bytes]]]:
+    """
+    Yields (srcname, read) for the files extract_and_get_names would find, but
+    without extracting the archive.  Zips only need their central directory
+    for this, and tars a single streaming pass.
+
+    read() returns the member's contents, and only until the next member is
+    yielded.
+    """
+    matches = _compile_patterns(tuple(patterns))
+    srckey = _make_srckey(strip_top_level)
+    format = _archive_format(archive_filename)
+    # What's been yielded already, in case a tar needs extracting after all
+    done: Set[str] = set()
+    if format == "zip":
+        with zipfile.ZipFile(archive_filename) as zf:
+            for zi in zf.infolist():
+                if not matches(os.path.normcase(zi.filename.rsplit("/", 1)[-1])):
+                    continue
+                relname = _member_relname(zi.filename)
+                if relname is None or zi.is_dir():
+                    continue
+                yield srckey(relname), functools.partial(zf.read, zi)
+        return
+    if format == "tar":
+        with tarfile.open(archive_filename, "r|*") as tf:
+            for ti in tf:
+                if not matches(os.path.normcase(ti.name.rsplit("/", 1)[-1])):
+                    continue
+                relname = _member_relname(ti.name)
+                if relname is None or ti.isdir():
+                    continue
+                if not ti.isfile():
+                    # Extracting would follow these (like _member_hashes, don't
+                    # guess); the rest comes from the extracted tree below.
+                    break
+                f = tf.extractfile(ti)
+                assert f is not None
+                key = srckey(relname)
+                done.add(key)
+                yield key, f.read
+            else:
+                return
+
+    archive_root, names = extract_and_get_names(
+        archive_filename, strip_top_level, patterns
+    )
+    for relname, srcname in names:
+        if srcname not in done:
+            yield srcname, Path(archive_root, relname).read_bytes
+
+
+class _MmapReader(io.RawIOBase):
+    """
+    A seekable file over an mmap, which ZipFile can't take directly (it wants
+    seekable()).  Reads are a copy out of the page cache rather than a syscall
+    each.
+    """
+
+    def __init__(self, mm: mmap.mmap) -> None:
+        self._mm = mm
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        return self._mm.read(size)
+
+    def seek(self, pos: int, whence: int = os.SEEK_SET) -> int:
+        self._mm.seek(pos, whence)
+        return self._mm.tell()
+
+    def tell(self) -> int:
+        return self._mm.tell()
+
+
+@contextmanager
+def _mapped(fh: IO[bytes]) -> Iterator[IO[bytes]]:
+    """
+    Yields an mmap-backed reader for fh, or fh itself if it can't be mapped
+    (say, it's empty).
+    """
+    try:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        yield fh
+        return
+    with mm:
+        yield cast(IO[bytes], _MmapReader(mm))
+
+
+def _member_relname(name: str) -> Optional[str]:
+    """
+    Returns the path an archive member would be extracted to, relative to the
+    extraction root, or None for one that would be skipped.
+    """
+    if name.startswith("/"):
+        return None
+    parts = [p for p in name.split("/") if p not in ("", ".")]
+    if not parts or ".." in parts:
+        return None
+    return os.path.join(*parts)
+
+
+def _batches(items: List[T]) -> List[List[T]]:
+    return [
+        items[i : i + HASH_BATCH_SIZE] for i in range(0, len(items), HASH_BATCH_SIZE)
+    ]
+
+
+def _hash_files(paths: List[str], algorithm: str) -> List[str]:
+    return [_hash_file(p, algorithm=algorithm) for p in paths]
+
+
+def _hash_file(
+    path: str, block_size: int = 1024 * 1024, algorithm: str = "sha1"
+) -> str:
+    """
+    Returns the hash of path's contents with CRLF normalized to LF, without
+    reading the whole file into memory.
+    """
+    with open(path, "rb") as buf:
+        return _hash_stream(buf, block_size, algorithm)
+
+
+def _hash_stream(
+    buf: IO[bytes], block_size: int = 1024 * 1024, algorithm: str = "sha1"
+) -> str:
+    h = hashlib.new(algorithm)
+    # A trailing \r is held back until we know whether a \n follows it in the
+    # next block.
+    prev_cr = False
+    block = buf.read(block_size)
+    if len(block) < block_size:
+        # Most source files fit in one read, which needs none of the
+        # bookkeeping below.
+        if b"\r" in block:
+            block = block.replace(b"\r\n", b"\n")
+        h.update(block)
+        return h.hexdigest()
+
+    while block:
+        if prev_cr and block[:1] != b"\n":
+            h.update(b"\r")
+        # Most files have no \r at all; finding that out is much cheaper than
+        # the copy replace makes regardless.
+        if b"\r" in block:
+            block = block.replace(b"\r\n", b"\n")
+            prev_cr = block.endswith(b"\r")
+            if prev_cr:
+                block = block[:-1]
+        else:
+            prev_cr = False
+        h.update(block)
+        block = buf.read(block_size)
+    if prev_cr:
+        h.update(b"\r")
+
+    return h.hexdigest()
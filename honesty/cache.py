@@ -2,22 +2,66 @@
 Cache-related stuff.
 """
 
+import asyncio
+import functools
+import hashlib
 import json
 import os
-import posixpath
+import shutil
+import sys
+import threading
 import urllib.parse
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager, suppress
 from pathlib import Path
 from tempfile import mkstemp
-from typing import Any, Dict, Optional
+from types import ModuleType
+from typing import (
+    Any,
+    Awaitable,
+    BinaryIO,
+    Coroutine,
+    Dict,
+    Iterator,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Set,
+    TYPE_CHECKING,
+    TypeVar,
+)
 
-import aiohttp
 import appdirs
 from indexurl import get_index_url
 from keke import kev, ktrace
-from requests.adapters import HTTPAdapter
-from requests.sessions import Session
+
+try:
+    from .__version__ import version as __version__
+except ImportError:
+    __version__ = "dev"
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+# A .hdrs is read for every cached file that's checked (see recorded_digest),
+# so parse straight from bytes, with orjson when it's installed.
+if orjson is not None:
+    json_loads = orjson.loads
+else:
+    json_loads = json.loads  # type: ignore[assignment]
+
+if TYPE_CHECKING:
+    # requests and aiohttp are slow to import, so they're only imported once
+    # they're needed.
+    from requests.sessions import Session
 
 
+# The same few packages get looked up over and over (every file of a release,
+# every dep edge pointing at a popular one), and Path construction isn't free.
+@functools.lru_cache(maxsize=4096)
 def cache_dir(pkg: str) -> Path:
     a = pkg[:2]
     b = pkg[2:4] or "--"
@@ -30,6 +74,162 @@ DEFAULT_CACHE_DIR = os.path.join(
 )
 BUFFER_SIZE = 4096 * 1024  # 4M
 
+T = TypeVar("T")
+
+# Nearly everything comes from the index host and one files host, so keep
+# a modest number of connections each and hold on to them between requests.
+# The CLI's --max-concurrency (api.DEFAULT_CONCURRENCY) defaults to fewer than
+# the per-host limit, so callers' own bounds are what usually apply.
+CONNECTION_LIMIT = 32
+CONNECTION_LIMIT_PER_HOST = 16
+KEEPALIVE_TIMEOUT = 75  # seconds
+DNS_CACHE_TTL = 300  # seconds
+
+# (connect, read) for requests; read is between bytes, not for the whole body
+SYNC_TIMEOUT = (5, 30)
+
+# How many paths Cache remembers as already downloaded
+PRESENT_CACHE_SIZE = 4096
+
+
+def _uvloop() -> Optional[ModuleType]:
+    """
+    Returns the uvloop module if it's installed (the `honesty[uvloop]` extra)
+    and hasn't been turned off with HONESTY_NO_UVLOOP=1.
+    """
+    if sys.platform == "win32" or os.environ.get("HONESTY_NO_UVLOOP"):
+        return None
+    try:
+        import uvloop
+    except ImportError:
+        return None
+    return uvloop
+
+
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    """Like asyncio.new_event_loop, but a uvloop one when that's available."""
+    uvloop = _uvloop()
+    if uvloop is not None:
+        loop: asyncio.AbstractEventLoop = uvloop.new_event_loop()
+        return loop
+    return asyncio.new_event_loop()
+
+
+def run(main: Coroutine[Any, Any, T]) -> T:
+    """Like asyncio.run, but on uvloop when that's available."""
+    uvloop = _uvloop()
+    if uvloop is not None:
+        result: T = uvloop.run(main)
+        return result
+    return asyncio.run(main)
+
+
+class _Prefetch(NamedTuple):
+    url: str
+    output_file: Path
+    hdrs_file: Path
+    # Whether output_file can be returned without making a request
+    cached: bool
+    # Conditional request headers, when revalidating an existing file
+    headers: Dict[str, str]
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+def _check_digest(url: str, actual: str, expected: Optional[str]) -> None:
+    if expected is not None and actual != expected:
+        raise ChecksumMismatch(f"{url} has sha256 {actual}, expected {expected}")
+
+
+# Cleared the first time O_TMPFILE turns out to be unusable (e.g. linking via
+# /proc isn't allowed), so we only pay for that once.
+_use_tmpfile = hasattr(os, "O_TMPFILE")
+
+
+@contextmanager
+def atomic_writer(output_file: Path) -> Iterator[BinaryIO]:
+    """
+    Yields a file to write the new contents of output_file to, which replaces
+    output_file only once the block finishes.  Last-writer-wins semantics,
+    even on Windows.
+
+    Where O_TMPFILE works the file has no name until it's complete, so there's
+    nothing to clean up if we're killed partway.
+    """
+    global _use_tmpfile
+
+    fd = -1
+    if _use_tmpfile:
+        try:
+            fd = os.open(output_file.parent, os.O_TMPFILE | os.O_RDWR, 0o644)
+        except OSError:
+            # Not every filesystem supports it
+            _use_tmpfile = False
+
+    if fd == -1:
+        # mkstemp's name is unique even across containers sharing the
+        # directory, which a pid isn't.
+        (fd, name) = mkstemp(prefix=f"{output_file.name}.", dir=output_file.parent)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                yield f
+            with kev("replace"):
+                os.replace(name, output_file)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.unlink(name)
+            raise
+        return
+
+    with os.fdopen(fd, "w+b") as f:
+        yield f
+        f.flush()
+        with kev("link"):
+            try:
+                _link_fd(fd, output_file)
+            except OSError:
+                _use_tmpfile = False
+                f.seek(0)
+                with atomic_writer(output_file) as f2:
+                    shutil.copyfileobj(f, f2, BUFFER_SIZE)
+
+
+def _link_fd(fd: int, output_file: Path) -> None:
+    proc_path = f"/proc/self/fd/{fd}"
+    try:
+        os.link(proc_path, output_file)
+    except FileExistsError:
+        # link can't overwrite, so give it a name to replace with.
+        name = f"{output_file}.{uuid.uuid4().hex}"
+        os.link(proc_path, name)
+        try:
+            os.replace(name, output_file)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.unlink(name)
+            raise
+
+
+def recorded_digest(path: Path, st: Optional[os.stat_result] = None) -> Optional[str]:
+    """
+    Returns the sha256 recorded in path's .hdrs when it was downloaded, or None
+    if it wasn't recorded or the file has changed since.  Pass st if you
+    already have it.
+    """
+    hdrs_file = path.with_name(path.name + ".hdrs")
+    try:
+        hdrs = json_loads(hdrs_file.read_bytes())
+        if st is None:
+            st = path.stat()
+        if hdrs.get("mtime_ns") != st.st_mtime_ns:
+            return None
+    except (OSError, ValueError):
+        return None
+    digest: Optional[str] = hdrs.get("sha256")
+    return digest
+
 
 class Cache:
     def __init__(
@@ -39,7 +239,9 @@ class Cache:
         json_index_url: Optional[str] = None,
         fresh_index: bool = False,
         aiohttp_client_session_kwargs: Optional[Dict[str, Any]] = None,
-        sync_session: Optional[Session] = None,
+        sync_session: Optional["Session"] = None,
+        connection_limit_per_host: Optional[int] = None,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
     ) -> None:
         if not cache_dir:
             cache_dir = os.environ.get("HONESTY_CACHE", DEFAULT_CACHE_DIR)
@@ -65,146 +267,272 @@ class Cache:
         cskwargs: Dict[str, Any] = {
             "trust_env": True,
             "raise_for_status": True,
+            "headers": {"User-Agent": f"honesty/{__version__}"},
         }
         if aiohttp_client_session_kwargs is not None:
             cskwargs.update(aiohttp_client_session_kwargs)
 
         self._cskwargs = cskwargs
-        if sync_session is None:
-            sync_session = Session()
-            sync_session.mount("http://", HTTPAdapter(pool_maxsize=100))
-            sync_session.mount("https://", HTTPAdapter(pool_maxsize=100))
-        self.sync_session = sync_session
+        # Can only lower the default; more than that just invites a 429.
+        self.connection_limit_per_host = min(
+            connection_limit_per_host or CONNECTION_LIMIT_PER_HOST,
+            CONNECTION_LIMIT_PER_HOST,
+        )
+        # Created on first use by the sync_session property
+        self._sync_session = sync_session
+        self._sync_session_lock = threading.Lock()
+        # run_sync's loop; one is made on first use (and closed on exit)
+        # unless the caller provides its own to share.
+        self._loop = loop
+        self._owns_loop = loop is None
+        self._session_open = False
+        # Package dirs we've already made sure exist
+        self._created_dirs: Set[Path] = set()
+        # Files known to be in the cache already, most recently used last.
+        # This saves a stat for repeat fetches in the same process.
+        self._present: "OrderedDict[Path, None]" = OrderedDict()
+        self._present_lock = threading.Lock()
+
+    @property
+    def sync_session(self) -> "Session":
+        with self._sync_session_lock:
+            if self._sync_session is None:
+                from requests.adapters import HTTPAdapter, Retry
+                from requests.sessions import Session
+
+                # One adapter, so http and https share the same pools.  There
+                # are only a couple of hosts, but many threads (see DepWalker)
+                # fetching from them at once.
+                adapter = HTTPAdapter(
+                    pool_connections=4,
+                    pool_maxsize=100,
+                    max_retries=Retry(
+                        total=3,
+                        backoff_factor=0.3,
+                        status_forcelist=(429, 500, 502, 503, 504),
+                        # Let raise_for_status report the final status
+                        raise_on_status=False,
+                    ),
+                )
+                sync_session = Session()
+                sync_session.headers["User-Agent"] = f"honesty/{__version__}"
+                sync_session.mount("http://", adapter)
+                sync_session.mount("https://", adapter)
+                self._sync_session = sync_session
+            return self._sync_session
+
+    def _fetch_common(
+        self, pkg: str, url: Optional[str], filename: Optional[str], revalidate: bool
+    ) -> _Prefetch:
+        """
+        The parts of fetching that don't depend on which http library is used.
 
-    @ktrace("pkg", "url")
-    def fetch(
-        self, pkg: str, url: Optional[str], filename: Optional[str] = None
-    ) -> Path:
-        # This duplicates the async_fetch code but using requests, for better
-        # non-async support.
+        When revalidate is set, an existing cached file is not trusted as-is,
+        but the returned headers will make the request conditional on it.
+        """
 
         # Because parse_index doesn't understand entities, there are some urls
         # that we currently get that we shouldn't bother fetching.
         if "&" in pkg or "#" in pkg:
             raise NotImplementedError("parse_index does not handle entities yet")
 
-        pkg_url = urllib.parse.urljoin(self.index_url, f"{pkg}/")
+        # index_url always ends with a slash, and pkg is a plain name, so this
+        # is what urljoin would give.
+        pkg_url = f"{self.index_url}{pkg}/"
         if url is None:
             url = pkg_url
-        else:
+        elif "://" not in url:
             # pypi simple gives full urls, but if your mirror gives relative ones,
             # it's relative to the package's index page (which has trailing slash)
             url = urllib.parse.urljoin(pkg_url, url)
 
         if not filename:
-            filename = posixpath.basename(url)
+            filename = url.rsplit("/", 1)[-1]
 
         output_dir = self.cache_path / cache_dir(pkg)
-        output_dir.mkdir(parents=True, exist_ok=True)
-
         output_file = output_dir / (filename or "index.html")
-
-        # Don't bother cache-freshening if a file exists under its final name.
-        if output_file.exists() and not self._is_index_filename(filename or ""):
-            return output_file
-
-        headers = {}
         hdrs_file = output_dir / ((filename or "index.html") + ".hdrs")
-        if output_file.exists():
-            # If things got out of sync, we don't want to return a nonexisting
-            # output_file...
-            if hdrs_file.exists():
-                hdrs = json.loads(hdrs_file.read_text())
-                if "etag" in hdrs:
-                    headers = {"If-None-Match": hdrs["etag"]}
-                elif "last-modified" in hdrs:
-                    headers = {"If-Modified-Since": hdrs["last-modified"]}
-                # pydepot doesn't provide this yet
-                # else:
-                #    raise Exception(f"Unknown headers {hdrs!r}")
-
-        # TODO reconsider timeout
-        with kev("get", have_headers=bool(headers), url=url):
-            resp = self.sync_session.get(
-                url, stream=True, headers=headers, timeout=None
-            )
+        freshen = revalidate and self._is_index_filename(filename or "")
 
-        resp.raise_for_status()
-        if resp.status_code == 304:
-            assert output_file.exists()
-            # print("used 304 for", url)
-            return output_file
+        if not freshen and self._is_known_present(output_file):
+            return _Prefetch(url, output_file, hdrs_file, True, {})
 
-        # TODO rethink how we write/cleanup these temp files
-        (fd, name) = mkstemp(
-            f".{os.getpid()}", prefix=(filename or "index.html"), dir=output_dir
-        )
-        f = os.fdopen(fd, "wb")
-        with kev("stream_body"):
-            for chunk in resp.iter_content(1024 * 1024):
-                f.write(chunk)
+        if output_dir not in self._created_dirs:
+            output_dir.mkdir(parents=True, exist_ok=True)
+            self._created_dirs.add(output_dir)
 
-        # Last-writer-wins semantics, even on Windows
-        with kev("replace"):
-            os.replace(name, output_file)
+        if not output_file.exists():
+            return _Prefetch(url, output_file, hdrs_file, False, {})
+
+        # Don't bother cache-freshening if a file exists under its final name.
+        if not freshen:
+            self._remember_present(output_file)
+            return _Prefetch(url, output_file, hdrs_file, True, {})
 
         headers = {}
-        if "etag" in resp.headers:
-            headers["etag"] = resp.headers["etag"]
-        elif "last-modified" in resp.headers:
-            headers["last-modified"] = resp.headers["last-modified"]
+        # If things got out of sync, we don't want to return a nonexisting
+        # output_file...
+        try:
+            hdrs = json_loads(hdrs_file.read_bytes())
+        except (OSError, ValueError):
+            # Missing or torn (it isn't written atomically); just refetch.
+            hdrs = {}
+        # Send both when we have them; a server that understands the etag
+        # ignores the date, and one that doesn't can still use the date.
+        if "etag" in hdrs:
+            headers["If-None-Match"] = hdrs["etag"]
+        if "last-modified" in hdrs:
+            headers["If-Modified-Since"] = hdrs["last-modified"]
+        # pydepot doesn't provide either yet
+        return _Prefetch(url, output_file, hdrs_file, False, headers)
+
+    def _is_known_present(self, path: Path) -> bool:
+        with self._present_lock:
+            if path not in self._present:
+                return False
+            self._present.move_to_end(path)
+            return True
+
+    def _remember_present(self, path: Path) -> None:
+        with self._present_lock:
+            self._present[path] = None
+            self._present.move_to_end(path)
+            if len(self._present) > PRESENT_CACHE_SIZE:
+                self._present.popitem(last=False)
+
+    def _save_headers(
+        self,
+        output_file: Path,
+        hdrs_file: Path,
+        resp_headers: Mapping[str, str],
+        sha256: str,
+    ) -> None:
+        headers: Dict[str, Any] = {}
+        for k in ("etag", "last-modified"):
+            if k in resp_headers:
+                headers[k] = resp_headers[k]
+        # The digest is only good as long as the file is the one we wrote.
+        headers["sha256"] = sha256
+        headers["mtime_ns"] = output_file.stat().st_mtime_ns
         # Don't bother with replace here, although this should happen after the
         # main file gets replaced.
         hdrs_file.write_text(json.dumps(headers))
 
-        return output_file
+    @ktrace("pkg", "url")
+    def fetch(
+        self,
+        pkg: str,
+        url: Optional[str],
+        filename: Optional[str] = None,
+        expected_sha256: Optional[str] = None,
+    ) -> Path:
+        # This shares _fetch_common with async_fetch but uses requests for the
+        # transfer, because it's called from worker threads (see DepWalker)
+        # where there's no event loop to share.
+        pf = self._fetch_common(pkg, url, filename, revalidate=True)
+        if pf.cached:
+            return pf.output_file
+
+        with kev("get", have_headers=bool(pf.headers), url=pf.url):
+            resp = self.sync_session.get(
+                pf.url, stream=True, headers=pf.headers, timeout=SYNC_TIMEOUT
+            )
+
+        # A streamed response only goes back to the pool once it's closed, so
+        # make sure that happens on every path.
+        with resp:
+            resp.raise_for_status()
+            if resp.status_code == 304:
+                assert pf.output_file.exists()
+                return pf.output_file
+
+            h = hashlib.sha256()
+            with atomic_writer(pf.output_file) as f:
+                with kev("stream_body"):
+                    for chunk in resp.iter_content(BUFFER_SIZE):
+                        h.update(chunk)
+                        f.write(chunk)
+                # Raising here keeps the bad download from being published
+                _check_digest(pf.url, h.hexdigest(), expected_sha256)
 
-    async def async_fetch(self, pkg: str, url: Optional[str]) -> Path:
+        self._save_headers(pf.output_file, pf.hdrs_file, resp.headers, h.hexdigest())
+        self._remember_present(pf.output_file)
+        return pf.output_file
+
+    async def async_fetch(
+        self,
+        pkg: str,
+        url: Optional[str],
+        expected_sha256: Optional[str] = None,
+        revalidate: Optional[bool] = None,
+    ) -> Path:
         """
         When url=None, download the index.
         Otherwise, download (presumably) an archive.  url may be relative, and
         is presumably relative to the package index page.
 
+        If expected_sha256 is given, a new download that doesn't match it
+        raises ChecksumMismatch (files already in the cache aren't rehashed).
+
         When self.fresh_index, never trust the cache for index (but still save).
+        revalidate, when not None, overrides that for this call.
 
         Returns a Path for where the cache wanted to save it.  We make effort to
         be concurrent-safe (last one wins).
         """
+        if revalidate is None:
+            revalidate = self.fresh_index
+        pf = self._fetch_common(pkg, url, None, revalidate=revalidate)
+        if pf.cached:
+            return pf.output_file
+
+        async with self.session.get(
+            pf.url, raise_for_status=True, timeout=None, headers=pf.headers
+        ) as resp:
+            if resp.status == 304:
+                assert pf.output_file.exists()
+                return pf.output_file
+
+            # Writes go to the default executor so that a slow disk doesn't
+            # stall other downloads sharing this loop.
+            loop = asyncio.get_running_loop()
+            h = hashlib.sha256()
+            with atomic_writer(pf.output_file) as f:
+                async for chunk in resp.content.iter_chunked(BUFFER_SIZE):
+                    h.update(chunk)
+                    await loop.run_in_executor(None, f.write, chunk)
+                _check_digest(pf.url, h.hexdigest(), expected_sha256)
+            self._save_headers(
+                pf.output_file, pf.hdrs_file, resp.headers, h.hexdigest()
+            )
+            self._remember_present(pf.output_file)
 
-        # Because parse_index doesn't understand entities, there are some urls
-        # that we currently get that we shouldn't bother fetching.
-        if "&" in pkg or "#" in pkg:
-            raise NotImplementedError("parse_index does not handle entities yet")
-
-        pkg_url = urllib.parse.urljoin(self.index_url, f"{pkg}/")
-        if url is None:
-            url = pkg_url
-        else:
-            # pypi simple gives full urls, but if your mirror gives relative ones,
-            # it's relative to the package's index page (which has trailing slash)
-            url = urllib.parse.urljoin(pkg_url, url)
-
-        filename = posixpath.basename(url)
-
-        output_dir = self.cache_path / cache_dir(pkg)
-        output_dir.mkdir(parents=True, exist_ok=True)
-
-        output_file = output_dir / (filename or "index.html")
+        return pf.output_file
 
-        if not output_file.exists() or (
-            self.fresh_index and self._is_index_filename(filename or "")
-        ):
-            async with self.session.get(
-                url, raise_for_status=True, timeout=None
-            ) as resp:
-                tmp = f"{output_file}.{os.getpid()}"
-                with open(tmp, "wb") as f:
-                    async for chunk in resp.content.iter_any():
-                        f.write(chunk)
-                # Last-writer-wins semantics, even on Windows
-                os.replace(tmp, output_file)
+    def get_digest(self, path: Path) -> Optional[str]:
+        """
+        Returns the sha256 recorded when `path` was downloaded, or None if it
+        wasn't recorded or the file has changed since.
+        """
+        return recorded_digest(path)
 
-        return output_file
+    def record_digest(self, path: Path) -> str:
+        """
+        Hashes `path` and records that in its .hdrs (keeping any etag or
+        last-modified already there), for files that get_digest has nothing
+        for, like ones downloaded before digests were recorded.
+        """
+        hdrs_file = path.with_name(path.name + ".hdrs")
+        try:
+            hdrs = json_loads(hdrs_file.read_bytes())
+        except (OSError, ValueError):
+            hdrs = {}
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(BUFFER_SIZE):
+                h.update(chunk)
+        self._save_headers(path, hdrs_file, hdrs, h.hexdigest())
+        return h.hexdigest()
 
     def _is_index_filename(self, name: str) -> bool:
         return name in ("", "json")
@@ -212,13 +540,52 @@ class Cache:
     def __enter__(self) -> "Cache":
         return self
 
+    def run_sync(self, coro: Awaitable[T]) -> T:
+        """
+        Runs coro (which can use self.session) to completion from sync code.
+
+        The event loop and session are created on first use and kept until
+        __exit__, so connections get reused across calls.  Not thread-safe.
+        """
+        if self._loop is None:
+            self._loop = new_event_loop()
+        if not self._session_open:
+            self._loop.run_until_complete(self.__aenter__())
+        return self._loop.run_until_complete(coro)
+
     def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> Any:
+        if self._loop is not None:
+            if self._session_open:
+                self._loop.run_until_complete(self.__aexit__(exc_type, exc, tb))
+            if self._owns_loop:
+                self._loop.close()
+                self._loop = None
         # TODO what is the right return value?
         return
 
     async def __aenter__(self) -> "Cache":
-        self.session = aiohttp.ClientSession(**self._cskwargs)
+        # Already open, say a Cache shared between commands (see cmdline)
+        if self._session_open:
+            return self
+
+        import aiohttp
+
+        cskwargs = self._cskwargs
+        if "connector" not in cskwargs:
+            # The session owns this, and closes it along with itself.
+            cskwargs = dict(
+                cskwargs,
+                connector=aiohttp.TCPConnector(
+                    limit=CONNECTION_LIMIT,
+                    limit_per_host=self.connection_limit_per_host,
+                    keepalive_timeout=KEEPALIVE_TIMEOUT,
+                    ttl_dns_cache=DNS_CACHE_TTL,
+                ),
+            )
+        self.session = aiohttp.ClientSession(**cskwargs)
+        self._session_open = True
         return self
 
     async def __aexit__(self, exc_type: Any, exc: Any, tb: Any) -> Any:
+        self._session_open = False
         await self.session.close()
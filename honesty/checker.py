@@ -1,19 +1,42 @@
+import asyncio
 import difflib
+import json
+import os
 import os.path
 import time
+from collections import defaultdict
 from pathlib import Path
-from typing import Dict, List, Set, Tuple, Union
+from typing import DefaultDict, Dict, Iterable, List, Optional, Set, Tuple, Union
 
 import click
-import toml
 from infer_license.api import guess_file
 from infer_license.types import License
 from packaging.version import Version
 
-from .archive import archive_hashes, extract_and_get_names
-from .cache import Cache
+from .archive import (
+    archive_hashes,
+    extract_and_get_names,
+    get_hash_dir,
+    iter_members,
+)
+from .cache import atomic_writer, Cache, json_loads, recorded_digest
 from .releases import FileEntry, FileType, Package
 
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    import toml as tomllib  # type: ignore[no-redef]
+
+# These hashes are only compared with each other, so use whichever is fastest;
+# with SHA extensions that's sha256.
+HASH_ALGORITHM = "sha256"
+# Part of the name of remembered run_checker verdicts; bump it when
+# _compare_hashes (or what it hashes) changes, so old verdicts aren't used.
+VERDICT_VERSION = 1
+
+# How many of a release's files to download at once
+FETCH_PARALLELISM = 8
+
 
 def run_checker(package: Package, version: Version, verbose: bool, cache: Cache) -> int:
     try:
@@ -21,7 +44,7 @@ def run_checker(package: Package, version: Version, verbose: bool, cache: Cache)
     except KeyError:
         raise click.ClickException(f"version={version} not available")
 
-    sdists = [f for f in rel.files if f.file_type == FileType.SDIST]
+    sdists = rel.sdists
 
     if not sdists:
         click.secho(f"{package.name} {version} no sdist", fg="red")
@@ -30,51 +53,54 @@ def run_checker(package: Package, version: Version, verbose: bool, cache: Cache)
         click.secho(f"{package.name} {version} only sdist", fg="green")
         return 0
 
-    local_paths: List[Tuple[FileEntry, Path]] = []
-    with click.progressbar(rel.files) as bar:
-        for fe in bar:
-            local_paths.append((fe, cache.fetch(pkg=package.name, url=fe.url)))
-            # TODO verify checksum
+    # These are independent, so fetch several at once on the cache's event
+    # loop; results are kept in rel.files order.
+    local_paths: List[Tuple[FileEntry, Path]] = list(
+        zip(rel.files, cache.run_sync(_fetch_files(package.name, rel.files, cache)))
+    )
 
-    sdist_hashes: Dict[str, str] = {}
-    for fe, lp in local_paths:
-        if fe.file_type == FileType.SDIST:
-            # assert not sdist_hashes # multiple sdists?
+    # The last sdist, without building a list of them all first
+    sdist_fe, sdist_lp = next(
+        (fe, lp) for fe, lp in reversed(local_paths) if fe.file_type == FileType.SDIST
+    )
+    sdist_hashes: Optional[Dict[str, str]] = None
+
+    def get_sdist_hashes() -> Dict[str, str]:
+        nonlocal sdist_hashes
+        if sdist_hashes is None:
             t0 = time.time()
-            sdist_hashes = archive_hashes(lp, True)
+            sdist_hashes = archive_hashes(
+                sdist_lp,
+                True,
+                algorithm=HASH_ALGORITHM,
+                archive_sha256=sdist_fe.sha256,
+            )
             t1 = time.time()
             if verbose:
-                print(f"{fe.basename} {t1 - t0}")
+                print(f"{sdist_fe.basename} {t1 - t0}")
+                for k, v in sdist_hashes.items():
+                    print(f"{k} {v}")
+        return sdist_hashes
 
     if verbose:
-        for k, v in sdist_hashes.items():
-            print(f"{k} {v}")
+        get_sdist_hashes()
 
     # [message] = set(filenames)
-    messages: Dict[str, Set[str]] = {}
+    messages: DefaultDict[str, Set[str]] = defaultdict(set)
     rc = 0
     for fe, lp in local_paths:
         if fe.file_type in (FileType.BDIST_WHEEL, FileType.BDIST_EGG):
-            t0 = time.time()
-            this_hashes = archive_hashes(lp)
-            t1 = time.time()
-            if verbose:
-                print(f"{fe.basename} {t1 - t0}")
-
-            msg = []
-            for k, h in sorted(this_hashes.items()):
-                if k not in sdist_hashes:
-                    # Intentionally not including has here, because
-                    # scipy/__config__.py has a different hash in each one and
-                    # I want them to coalesce
-                    msg.append(f"    {k} not in sdist")
-                    rc |= 4
-                elif h != sdist_hashes[k]:
-                    msg.append(f"    {k} differs from sdist {h}")
-                    rc |= 8
-
+            # The outcome only depends on the two archives' contents, so if
+            # we've compared these exact ones before, neither needs reading.
+            verdict_path = _verdict_path(sdist_fe, sdist_lp, fe, lp)
+            verdict = _load_verdict(verdict_path)
+            if verdict is None:
+                verdict = _compare_hashes(fe, lp, get_sdist_hashes(), verbose)
+                _save_verdict(verdict_path, verdict)
+            this_rc, msg = verdict
+            rc |= this_rc
             if msg:
-                messages.setdefault("\n".join(msg), set()).add(fe.basename)
+                messages[msg].add(fe.basename)
 
     if rc == 0:
         click.secho(f"{package.name} {version} OK", fg="green")
@@ -88,19 +114,163 @@ def run_checker(package: Package, version: Version, verbose: bool, cache: Cache)
     return rc
 
 
-def is_pep517(package: Package, version: Version, verbose: bool, cache: Cache) -> bool:
-    archive_root, names = _version_helper(
-        package, version, cache, FileType.SDIST, ("pyproject.toml",)
+def _compare_hashes(
+    fe: FileEntry, lp: Path, sdist_hashes: Dict[str, str], verbose: bool
+) -> Tuple[int, str]:
+    """
+    Returns (rc, message) for how the .py files in one wheel or egg differ from
+    the sdist's.
+    """
+    t0 = time.time()
+    this_hashes = archive_hashes(lp, algorithm=HASH_ALGORITHM, archive_sha256=fe.sha256)
+    t1 = time.time()
+    if verbose:
+        print(f"{fe.basename} {t1 - t0}")
+
+    rc = 0
+    # Usually empty, so only this (and not every file) gets sorted for
+    # stable output.
+    mismatched: List[Tuple[str, Optional[str]]] = []
+    for k, h in this_hashes.items():
+        if k not in sdist_hashes:
+            mismatched.append((k, None))
+            rc |= 4
+        elif h != sdist_hashes[k]:
+            mismatched.append((k, h))
+            rc |= 8
+
+    msg = []
+    for k, h in sorted(mismatched):
+        if h is None:
+            # Intentionally not including has here, because
+            # scipy/__config__.py has a different hash in each one and
+            # I want them to coalesce
+            msg.append(f"    {k} not in sdist")
+        else:
+            msg.append(f"    {k} differs from sdist {h}")
+    return rc, "\n".join(msg)
+
+
+def _verdict_path(
+    sdist: FileEntry, sdist_lp: Path, other: FileEntry, other_lp: Path
+) -> Optional[str]:
+    """
+    Where the result of comparing these two archives is remembered, or None if
+    it shouldn't be.  The key is their digests from the index, so that's only
+    used when both files on disk are known to have them; a damaged or stale
+    one gets compared afresh instead.
+    """
+    if not sdist.sha256 or not other.sha256:
+        return None
+    if (
+        recorded_digest(sdist_lp) != sdist.sha256
+        or recorded_digest(other_lp) != other.sha256
+    ):
+        return None
+    return os.path.join(
+        get_hash_dir(),
+        "verdicts",
+        f"{sdist.sha256}_{other.sha256}-{HASH_ALGORITHM}-{VERDICT_VERSION}.json",
     )
-    for relname, srcname in names:
+
+
+def _load_verdict(path: Optional[str]) -> Optional[Tuple[int, str]]:
+    if not path:
+        return None
+    try:
+        d = json_loads(Path(path).read_bytes())
+        return d["rc"], d["message"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _save_verdict(path: Optional[str], verdict: Tuple[int, str]) -> None:
+    if not path:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_writer(Path(path)) as f:
+        f.write(json.dumps({"rc": verdict[0], "message": verdict[1]}).encode())
+
+
+async def _fetch_files(pkg: str, files: List[FileEntry], cache: Cache) -> List[Path]:
+    sem = asyncio.Semaphore(FETCH_PARALLELISM)
+
+    async def _bound(fe: FileEntry) -> Path:
+        async with sem:
+            return await cache.async_fetch(pkg, fe.url, expected_sha256=fe.sha256)
+
+    tasks = [asyncio.ensure_future(_bound(fe)) for fe in files]
+    try:
+        with click.progressbar(length=len(tasks)) as bar:
+            for fut in asyncio.as_completed(tasks):
+                await fut
+                bar.update(1)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return [t.result() for t in tasks]
+
+
+def prefetch_dists(
+    cache: Cache,
+    targets: Iterable[Tuple[Package, Version]],
+    desired_type: Optional[FileType],
+    concurrency: int = FETCH_PARALLELISM,
+) -> None:
+    """
+    Downloads, `concurrency` at a time, what the checks below will want for
+    each (package, version): the file _fetch_dist would pick for
+    `desired_type`, or every file if that's None (for run_checker).  The checks
+    themselves then run one after another (so their output stays in order),
+    but find everything already in the cache.
+
+    Failures are ignored here; the check that needs that file will report it.
+    """
+    files: List[Tuple[str, FileEntry]] = []
+    for package, version in targets:
+        rel = package.releases.get(version)
+        if rel is None:
+            continue
+        if desired_type is None:
+            files.extend((package.name, fe) for fe in rel.files)
+        else:
+            fe = next((f for f in rel.files if f.file_type == desired_type), None)
+            if fe is not None:
+                files.append((package.name, fe))
+
+    async def _fetch_all() -> None:
+        sem = asyncio.Semaphore(concurrency)
+
+        async def _bound(pkg: str, fe: FileEntry) -> Path:
+            async with sem:
+                return await cache.async_fetch(pkg, fe.url, expected_sha256=fe.sha256)
+
+        await asyncio.gather(
+            *(_bound(pkg, fe) for pkg, fe in files), return_exceptions=True
+        )
+
+    if files:
+        cache.run_sync(_fetch_all())
+
+
+def is_pep517(package: Package, version: Version, verbose: bool, cache: Cache) -> bool:
+    lp = _fetch_dist(package, version, cache, FileType.SDIST)
+    # Read straight from the archive; extracting the whole sdist to look at
+    # one small file is most of the cost.
+    for srcname, read in iter_members(lp, True, ("pyproject.toml",)):
         # TODO for a couple of projects this is finding test fixtures, we
         # should only be looking alongside the rootmost setup.py
         if srcname.endswith("pyproject.toml"):
-            with open(os.path.join(archive_root, relname), "rb") as buf:
-                data = buf.read().replace(b"\r\n", b"\n")
-
-            t = toml.loads(data.decode("utf-8"))
-            bb = t.get("build-system", {}).get("build-backend", "?")
+            data = read().replace(b"\r\n", b"\n")
+
+            # Plenty of these are only tool config; no need to parse those.
+            if b"build-backend" in data:
+                t = tomllib.loads(data.decode("utf-8"))
+                bb = t.get("build-system", {}).get("build-backend", "?")
+            else:
+                bb = "?"
             click.echo(f"{package.name} {bb}")
             return True
     else:
@@ -114,17 +284,16 @@ def guess_license(
     archive_root, names = _version_helper(
         package, version, cache, FileType.SDIST, ("LICENSE*", "COPY*")
     )
-    result_path = None
-    result: Union[License, str, None] = None
-    for relname, srcname in names:
-        # TODO for a couple of projects this is finding test fixtures, we
-        # should only be looking alongside the rootmost setup.py
-        guess = guess_file(os.path.join(archive_root, relname))
-        if result_path is None or len(relname) < len(result_path):
-            result_path = relname
-            result = guess
-
-    if result is None and result_path:
+    if not names:
+        return None
+
+    # TODO for a couple of projects this is finding test fixtures, we
+    # should only be looking alongside the rootmost setup.py
+    # Only the shallowest one's guess is used, so that's the only one worth
+    # the (slow) guessing.
+    relname, _ = min(names, key=lambda n: len(n[0]))
+    result: Union[License, str, None] = guess_file(os.path.join(archive_root, relname))
+    if result is None:
         result = "Present but unknown"
     return result
 
@@ -132,11 +301,9 @@ def guess_license(
 def has_nativemodules(
     package: Package, version: Version, verbose: bool, cache: Cache
 ) -> bool:
-    archive_root, names = _version_helper(
-        package, version, cache, FileType.BDIST_WHEEL, ("*.so", "*.dll")
-    )
-
-    for relname, srcname in names:
+    lp = _fetch_dist(package, version, cache, FileType.BDIST_WHEEL)
+    # Only names matter here, and the wheel's central directory has those.
+    for srcname, _ in iter_members(lp, True, ("*.so", "*.dll")):
         # TODO for a couple of projects this is finding test fixtures, we
         # should only be looking alongside the rootmost setup.py
         if srcname.endswith(".so") or srcname.endswith(".dll"):
@@ -153,6 +320,16 @@ def _version_helper(
     desired_type: FileType,
     patterns: Tuple[str, ...],
 ) -> Tuple[str, List[Tuple[str, str]]]:
+    lp = _fetch_dist(package, version, cache, desired_type)
+    archive_root, names = extract_and_get_names(
+        lp, strip_top_level=True, patterns=patterns
+    )
+    return archive_root, names
+
+
+def _fetch_dist(
+    package: Package, version: Version, cache: Cache, desired_type: FileType
+) -> Path:
     try:
         rel = package.releases[version]
     except KeyError:
@@ -166,11 +343,7 @@ def _version_helper(
     # if verbose:
     #     click.echo(f"{package.name} {version} {dists[0].basename}")
 
-    lp = cache.fetch(pkg=package.name, url=dists[0].url)
-    archive_root, names = extract_and_get_names(
-        lp, strip_top_level=True, patterns=patterns
-    )
-    return archive_root, names
+    return cache.fetch(pkg=package.name, url=dists[0].url)
 
 
 def shorten(subj: str, n: int = 50) -> str:
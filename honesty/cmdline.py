@@ -1,19 +1,21 @@
 import asyncio
+import atexit
 import functools
 import hashlib
 import json
 import logging
 import os.path
+import re
 import shutil
 import sys
 import threading
 import time
-from datetime import datetime, timezone
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
 from enum import Enum, IntEnum
 from pathlib import Path
-from typing import Any, IO, List, Optional, Set, Tuple
-
-import aiohttp.client_exceptions
+from typing import Any, Callable, Dict, IO, Iterator, List, Optional, Set, Tuple
 
 import click
 import keke
@@ -21,56 +23,342 @@ from packaging.utils import canonicalize_name
 
 from packaging.version import Version
 
-from .api import async_download_many
-from .archive import extract_and_get_names
-from .cache import Cache
-from .checker import guess_license, has_nativemodules, is_pep517, run_checker
-from .deps import DepWalker, is_canonical, POOL, print_deps, print_flat_deps
-from .releases import async_parse_index, FileType, Package, parse_index
+from .api import _fast_copy, async_download_many, DEFAULT_CONCURRENCY
+from .cache import (
+    BUFFER_SIZE,
+    Cache,
+    json_loads,
+    new_event_loop,
+    recorded_digest,
+    run,
+)
+from .releases import (
+    _parse_version,
+    async_parse_index,
+    async_parse_indexes,
+    FileEntry,
+    FileType,
+    Package,
+)
 from .requirements import _iter_simple_requirements
-from .vcs import CloneAnalyzer, extract2
+
+# .archive, .checker, .deps and .vcs (and what they pull in, like pkginfo and
+# infer_license) are imported inside the commands that use them, so that
+# `honesty list` and friends don't pay for them at startup.
 
 try:
     from .__version__ import version as __version__
 except ImportError:
     __version__ = "dev"
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+
+def _reuse_session() -> bool:
+    """
+    Whether commands run in this process share one event loop and Cache (and
+    so its open connections), for calling them repeatedly from Python, like
+    `cli.main([...], standalone_mode=False)` in a loop.
+    """
+    return os.environ.get("HONESTY_REUSE_SESSION") == "1"
+
+
+@functools.lru_cache(maxsize=1)
+def _shared_loop() -> asyncio.AbstractEventLoop:
+    loop = new_event_loop()
+    atexit.register(loop.close)
+    return loop
+
+
+_LOOP_KEY = "honesty.loop"
+
+
+@contextmanager
+def _cli_loop() -> Iterator[asyncio.AbstractEventLoop]:
+    """
+    The event loop for one run of cli, used both by its (wrap_async) command
+    and by any sync Cache the command makes, rather than each setting up and
+    tearing down a loop of its own.
+    """
+    if _reuse_session():
+        # The shared Cache's session belongs to this loop
+        yield _shared_loop()
+        return
+    loop = new_event_loop()
+    try:
+        yield loop
+    finally:
+        # What asyncio.run does on the way out
+        try:
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            if sys.version_info >= (3, 9):
+                loop.run_until_complete(loop.shutdown_default_executor())
+        finally:
+            loop.close()
+
+
+def _current_loop() -> Optional[asyncio.AbstractEventLoop]:
+    """
+    The loop set up by cli (see _cli_loop), or None when a command is invoked
+    on its own, outside the group.
+    """
+    ctx = click.get_current_context(silent=True)
+    loop: Optional[asyncio.AbstractEventLoop] = (
+        ctx.meta.get(_LOOP_KEY) if ctx is not None else None
+    )
+    if loop is None and _reuse_session():
+        loop = _shared_loop()
+    return loop
+
 
 # TODO type
 def wrap_async(coro: Any) -> Any:
     @functools.wraps(coro)
     def inner(*args: Any, **kwargs: Any) -> Any:
-        return asyncio.run(coro(*args, **kwargs))
+        loop = _current_loop()
+        if loop is None:
+            return run(coro(*args, **kwargs))
+        return loop.run_until_complete(coro(*args, **kwargs))
 
     return inner
 
 
+def _enum_name(obj: Enum) -> str:
+    return obj.name
+
+
+def _dataclass_fields(obj: Any) -> Dict[str, Any]:
+    # Not vars(), which would also have any cached_property values
+    return {name: getattr(obj, name) for name in obj.__dataclass_fields__}
+
+
+# Filled in per concrete type the first time dataclass_default sees one, so
+# `list --as_json` does one dict lookup per object rather than the whole chain.
+_DEFAULT_BY_TYPE: Dict[type, Callable[[Any], Any]] = {
+    datetime: str,
+    Version: str,
+}
+
+
 def dataclass_default(obj: Any) -> Any:
-    if hasattr(obj, "__dataclass_fields__"):
-        return obj.__dict__
-    elif isinstance(obj, (Enum, IntEnum)):
-        return obj.name
-    elif isinstance(obj, datetime):
-        return str(obj)
-    else:
-        raise TypeError(obj)
+    t = type(obj)
+    fn = _DEFAULT_BY_TYPE.get(t)
+    if fn is None:
+        if hasattr(obj, "__dataclass_fields__"):
+            fn = _dataclass_fields
+        elif isinstance(obj, (Enum, IntEnum)):
+            fn = _enum_name
+        elif isinstance(obj, (datetime, Version)):
+            fn = str
+        else:
+            raise TypeError(obj)
+        _DEFAULT_BY_TYPE[t] = fn
+    return fn(obj)
+
+
+def _json_line(obj: Any) -> str:
+    """
+    Serializes obj (usually a dataclass) with sorted keys, using orjson when
+    it's installed.  Its output is compact, but otherwise the same: dataclasses
+    and datetimes are passed through to dataclass_default (orjson's own
+    wouldn't sort dataclass keys, and would include cached_property values), and
+    the only enums are IntEnums, which both treat as ints.
+    """
+    if orjson is None:
+        return json.dumps(obj, default=dataclass_default, sort_keys=True)
+    return orjson.dumps(
+        obj,
+        default=dataclass_default,
+        option=orjson.OPT_SORT_KEYS
+        | orjson.OPT_PASSTHROUGH_DATACLASS
+        | orjson.OPT_PASSTHROUGH_DATETIME,
+    ).decode()
+
+
+# Seconds between --stats samples; a trace doesn't need finer than this, and
+# the sampling thread shouldn't perturb what it's measuring.
+STATS_INTERVAL = 0.05
 
 
 def _stats_thread() -> None:
-    prev_ts = None
-    prev_process_time = None
+    prev_ts = time.monotonic()
+    prev_process_time = time.process_time()
+    deadline = prev_ts
     while True:
-        ts = time.time()
-        process_time = time.process_time()
-        if prev_ts is not None:
-            keke.kcount(
-                "proc_cpu_pct",
-                100 * (process_time - prev_process_time) / (ts - prev_ts),
-            )
+        # Fixed period, rather than sleeping a fixed amount after each sample
+        # (which drifts by however long sampling took).
+        deadline += STATS_INTERVAL
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # Fell behind (e.g. suspended); carry on from now, without a burst
+            deadline -= delay
 
+        ts = time.monotonic()
+        process_time = time.process_time()
+        keke.kcount(
+            "proc_cpu_pct",
+            100 * (process_time - prev_process_time) / (ts - prev_ts),
+        )
         prev_ts = ts
         prev_process_time = process_time
-        time.sleep(0.01)
+
+
+class _CacheContext:
+    """
+    What a command enters (with `with` or `async with`) to get its Cache.  A
+    shared one (see _reuse_session) is left open for the next command.
+    """
+
+    def __init__(self, cache: Cache, shared: bool) -> None:
+        self.cache = cache
+        self.shared = shared
+
+    def __enter__(self) -> Cache:
+        return self.cache if self.shared else self.cache.__enter__()
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> Any:
+        if not self.shared:
+            return self.cache.__exit__(exc_type, exc, tb)
+
+    async def __aenter__(self) -> Cache:
+        # Opens the session the first time, even when shared
+        return await self.cache.__aenter__()
+
+    async def __aexit__(self, exc_type: Any, exc: Any, tb: Any) -> Any:
+        if not self.shared:
+            return await self.cache.__aexit__(exc_type, exc, tb)
+
+
+@functools.lru_cache(maxsize=None)
+def _shared_cache(**kwargs: Any) -> Cache:
+    # Its session is opened by the first command to use it, on the loop that
+    # wrap_async also uses.
+    cache = Cache(loop=_shared_loop(), **kwargs)
+    # Runs before the loop is closed, since that was registered first
+    atexit.register(cache.__exit__, None, None, None)
+    return cache
+
+
+def _make_cache(**kwargs: Any) -> _CacheContext:
+    """
+    A Cache for a command, which keeps to the group's -p connections per host.
+    """
+    parallelism = click.get_current_context().find_root().params.get("parallelism")
+    if _reuse_session():
+        return _CacheContext(
+            _shared_cache(connection_limit_per_host=parallelism, **kwargs), True
+        )
+    cache = Cache(
+        connection_limit_per_host=parallelism, loop=_current_loop(), **kwargs
+    )
+    return _CacheContext(cache, False)
+
+
+def _parse_indexes(
+    cache: Cache,
+    package_names: List[str],
+    use_json: bool,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    revalidate: Optional[bool] = None,
+) -> Tuple[List[Tuple[str, str, str, Package]], int]:
+    """
+    Sync version of _async_parse_indexes, run on cache's event loop.
+    """
+    return cache.run_sync(
+        _async_parse_indexes(cache, package_names, use_json, concurrency, revalidate)
+    )
+
+
+def _expand_stdin(package_names: List[str]) -> List[str]:
+    """
+    Replaces a `-` argument with the whitespace-separated names on stdin, so
+    a long list can go through one process (and one Cache, with its open
+    connections) instead of many via xargs.
+    """
+    if "-" not in package_names:
+        return package_names
+    result: List[str] = []
+    for package_name in package_names:
+        if package_name == "-":
+            result.extend(sys.stdin.read().split())
+        else:
+            result.append(package_name)
+    return result
+
+
+def _utc_day(value: str, option: str) -> datetime:
+    """
+    Midnight UTC at the start of a yyyy-mm-dd date option.  Only that form is
+    accepted, so a time or offset can't be given and then quietly ignored, and
+    newer Pythons' other fromisoformat forms (20200111, week dates) aren't
+    either.
+    """
+    if not re.fullmatch(r"\d{4}-\d{2}-\d{2}", value):
+        raise click.BadParameter(f"{value!r} is not yyyy-mm-dd", param_hint=option)
+    try:
+        day = date.fromisoformat(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint=option)
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+
+
+async def _async_parse_indexes(
+    cache: Cache,
+    package_names: List[str],
+    use_json: bool,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    revalidate: Optional[bool] = None,
+) -> Tuple[List[Tuple[str, str, str, Package]], int]:
+    """
+    Splits each `name==version` argument and fetches their indexes with
+    async_parse_indexes (only `concurrency` at once, so a long list doesn't
+    open a connection per package and get rate limited).  Commands expand `-`
+    (see _expand_stdin) themselves first, once, since they need the full list
+    for their own checks too.
+
+    Returns (package_name, operator, version, package) in argument order, and
+    an rc with the 2 bit set if any couldn't be fetched (those are reported
+    and left out).  A name given more than once (say `foo==1.0 foo==2.0`) is
+    only fetched once.
+
+    revalidate is passed along to async_parse_index (by default, cached
+    indexes are only rechecked with --fresh).
+    """
+    # Deferred since it's slow
+    import aiohttp.client_exceptions
+
+    parsed = [package_name.partition("==") for package_name in package_names]
+    unique_names = [*dict.fromkeys(package_name for package_name, _, _ in parsed)]
+    results = dict(
+        zip(
+            unique_names,
+            await async_parse_indexes(
+                unique_names,
+                cache,
+                use_json=use_json,
+                concurrency=concurrency,
+                revalidate=revalidate,
+            ),
+        )
+    )
+
+    rc = 0
+    packages = []
+    for package_name, operator, version in parsed:
+        result = results[package_name]
+        if isinstance(result, aiohttp.client_exceptions.ClientResponseError):
+            click.secho(f"Error: {package_name} got {result!r}", fg="red")
+            rc |= 2
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            packages.append((package_name, operator, version, result))
+    return packages, rc
 
 
 @click.group()
@@ -91,12 +379,16 @@ def cli(
 ) -> None:
     if trace:
         ctx.with_resource(keke.TraceOutput(trace))
-    logging.basicConfig(level=logging.DEBUG if verbose else logging.WARNING)
-    if stats:
+    # Closed after the subcommand (and its Cache) is done with it.
+    ctx.meta[_LOOP_KEY] = ctx.with_resource(_cli_loop())
+    # Leave logging alone if whatever is calling us has already set it up.
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.DEBUG if verbose else logging.WARNING)
+    # Samples only go to the trace, so there's nothing to do without one.
+    if stats and trace:
         threading.Thread(target=_stats_thread, daemon=True).start()
-
-    # Presumably nothing has run on it yet...
-    POOL._max_workers = parallelism
+    # Subcommands read parallelism from here when they need it: deps sizes its
+    # pool with it, checkcache its hashing, and _make_cache connections per host.
 
 
 @cli.command(help="List available archives")
@@ -109,42 +401,66 @@ def cli(
 async def list(
     fresh: bool, nouse_json: bool, as_json: bool, justver: bool, package_name: str
 ) -> None:
-    async with Cache(fresh_index=fresh) as cache:
+    async with _make_cache(fresh_index=fresh) as cache:
         package = await async_parse_index(package_name, cache, use_json=not nouse_json)
 
     if justver:
         selected_versions = select_versions(package, "==", "")
         print(f"{package_name}=={selected_versions[-1]}")
     elif as_json:
-        for k, v in package.releases.items():
-            print(json.dumps(v, default=dataclass_default, sort_keys=True))
+        sys.stdout.write(
+            "".join(f"{_json_line(v)}\n" for v in package.releases.values())
+        )
     else:
-        print(f"package {package.name}")
-        print("releases:")
+        # Built up and written once; print per line is a lot of overhead for
+        # packages with thousands of files.
+        lines = [f"package {package.name}\n", "releases:\n"]
         for k, v in package.releases.items():
-            print(f"  {k}:")
+            lines.append(f"  {k}:\n")
             for f in v.files:
                 if f.requires_python:
-                    print(f"    {f.basename} (requires_python {f.requires_python})")
+                    lines.append(
+                        f"    {f.basename} (requires_python {f.requires_python})\n"
+                    )
                 else:
-                    print(f"    {f.basename}")
+                    lines.append(f"    {f.basename}\n")
+        sys.stdout.write("".join(lines))
 
 
 @cli.command(help="Check for consistency among archives")
 @click.option("--verbose", "-v", is_flag=True, type=bool)
 @click.option("--fresh", "-f", is_flag=True, type=bool)
 @click.option("--nouse_json", is_flag=True, type=bool)
+@click.option(
+    "--max-concurrency",
+    default=DEFAULT_CONCURRENCY,
+    type=int,
+    help="How many requests to have in flight at once",
+)
 @click.argument("package_names", nargs=-1)
 def check(
-    verbose: bool, fresh: bool, nouse_json: bool, package_names: List[str]
+    verbose: bool,
+    fresh: bool,
+    nouse_json: bool,
+    max_concurrency: int,
+    package_names: List[str],
 ) -> None:
-    rc = 0
-    with Cache(fresh_index=fresh) as cache:
-        for package_name in package_names:
-            package_name, operator, version = package_name.partition("==")
-            package = parse_index(package_name, cache, use_json=not nouse_json)
-            selected_versions = select_versions(package, operator, version)
+    from .checker import prefetch_dists, run_checker
 
+    package_names = _expand_stdin(package_names)
+    with _make_cache(fresh_index=fresh) as cache:
+        # Always ask whether the index changed, so "latest" is really latest.
+        packages, rc = _parse_indexes(
+            cache, package_names, not nouse_json, max_concurrency, revalidate=True
+        )
+        selected = _select_all_versions(packages)
+        prefetch_dists(
+            cache,
+            [(package, v) for _, package, versions in selected for v in versions],
+            None,
+            max_concurrency,
+        )
+        for package_name, package, selected_versions in selected:
             if verbose:
                 click.echo(f"check {package_name} {selected_versions}")
 
@@ -159,17 +475,36 @@ def check(
 @click.option("--verbose", "-v", is_flag=True, type=bool)
 @click.option("--fresh", "-f", is_flag=True, type=bool)
 @click.option("--nouse_json", is_flag=True, type=bool)
+@click.option(
+    "--max-concurrency",
+    default=DEFAULT_CONCURRENCY,
+    type=int,
+    help="How many requests to have in flight at once",
+)
 @click.argument("package_names", nargs=-1)
 def ispep517(
-    verbose: bool, fresh: bool, nouse_json: bool, package_names: List[str]
+    verbose: bool,
+    fresh: bool,
+    nouse_json: bool,
+    max_concurrency: int,
+    package_names: List[str],
 ) -> None:
-    rc = 0
-    with Cache(fresh_index=fresh) as cache:
-        for package_name in package_names:
-            package_name, operator, version = package_name.partition("==")
-            package = parse_index(package_name, cache, use_json=not nouse_json)
-            selected_versions = select_versions(package, operator, version)
+    from .checker import is_pep517, prefetch_dists
 
+    package_names = _expand_stdin(package_names)
+    with _make_cache(fresh_index=fresh) as cache:
+        # Always ask whether the index changed, so "latest" is really latest.
+        packages, rc = _parse_indexes(
+            cache, package_names, not nouse_json, max_concurrency, revalidate=True
+        )
+        selected = _select_all_versions(packages)
+        prefetch_dists(
+            cache,
+            [(package, v) for _, package, versions in selected for v in versions],
+            FileType.SDIST,
+            max_concurrency,
+        )
+        for package_name, package, selected_versions in selected:
             if verbose:
                 click.echo(f"check {package_name} {selected_versions}")
 
@@ -184,17 +519,36 @@ def ispep517(
 @click.option("--verbose", "-v", is_flag=True, type=bool)
 @click.option("--fresh", "-f", is_flag=True, type=bool)
 @click.option("--nouse_json", is_flag=True, type=bool)
+@click.option(
+    "--max-concurrency",
+    default=DEFAULT_CONCURRENCY,
+    type=int,
+    help="How many requests to have in flight at once",
+)
 @click.argument("package_names", nargs=-1)
 def native(
-    verbose: bool, fresh: bool, nouse_json: bool, package_names: List[str]
+    verbose: bool,
+    fresh: bool,
+    nouse_json: bool,
+    max_concurrency: int,
+    package_names: List[str],
 ) -> None:
-    rc = 0
-    with Cache(fresh_index=fresh) as cache:
-        for package_name in package_names:
-            package_name, operator, version = package_name.partition("==")
-            package = parse_index(package_name, cache, use_json=not nouse_json)
-            selected_versions = select_versions(package, operator, version)
+    from .checker import has_nativemodules, prefetch_dists
 
+    package_names = _expand_stdin(package_names)
+    with _make_cache(fresh_index=fresh) as cache:
+        # Always ask whether the index changed, so "latest" is really latest.
+        packages, rc = _parse_indexes(
+            cache, package_names, not nouse_json, max_concurrency, revalidate=True
+        )
+        selected = _select_all_versions(packages)
+        prefetch_dists(
+            cache,
+            [(package, v) for _, package, versions in selected for v in versions],
+            FileType.BDIST_WHEEL,
+            max_concurrency,
+        )
+        for package_name, package, selected_versions in selected:
             if verbose:
                 click.echo(f"check {package_name} {selected_versions}")
 
@@ -209,20 +563,39 @@ def native(
 @click.option("--verbose", "-v", is_flag=True, type=bool)
 @click.option("--fresh", "-f", is_flag=True, type=bool)
 @click.option("--nouse_json", is_flag=True, type=bool)
+@click.option(
+    "--max-concurrency",
+    default=DEFAULT_CONCURRENCY,
+    type=int,
+    help="How many requests to have in flight at once",
+)
 @click.argument("package_names", nargs=-1)
 def license(
-    verbose: bool, fresh: bool, nouse_json: bool, package_names: List[str]
+    verbose: bool,
+    fresh: bool,
+    nouse_json: bool,
+    max_concurrency: int,
+    package_names: List[str],
 ) -> None:
-    with Cache(fresh_index=fresh) as cache:
-        for package_name in package_names:
-            package_name, operator, version = package_name.partition("==")
-            package = parse_index(package_name, cache, use_json=not nouse_json)
-            selected_versions = select_versions(package, operator, version)
+    from .checker import guess_license, prefetch_dists
 
+    package_names = _expand_stdin(package_names)
+    with _make_cache(fresh_index=fresh) as cache:
+        # Always ask whether the index changed, so "latest" is really latest.
+        packages, rc = _parse_indexes(
+            cache, package_names, not nouse_json, max_concurrency, revalidate=True
+        )
+        selected = _select_all_versions(packages)
+        prefetch_dists(
+            cache,
+            [(package, v) for _, package, versions in selected for v in versions],
+            FileType.SDIST,
+            max_concurrency,
+        )
+        for package_name, package, selected_versions in selected:
             if verbose:
                 click.echo(f"check {package_name} {selected_versions}")
 
-            rc = 0
             for v in selected_versions:
                 license = guess_license(package, v, verbose=verbose, cache=cache)
                 if license is not None and not isinstance(license, str):
@@ -244,6 +617,12 @@ def license(
     "--index-url",
     help="Alternate index url (uses HONESTY_INDEX_URL or pypi by default)",
 )
+@click.option(
+    "--max-concurrency",
+    default=DEFAULT_CONCURRENCY,
+    type=int,
+    help="How many requests to have in flight at once",
+)
 @click.argument("package_names", nargs=-1)
 @wrap_async
 async def download(
@@ -252,8 +631,10 @@ async def download(
     nouse_json: bool,
     dest: str,
     index_url: Optional[str],
+    max_concurrency: int,
     package_names: List[str],
 ) -> None:
+    package_names = _expand_stdin(package_names)
     if dest and len(package_names) > 1:
         # select_versions() may also result in more than one, but that seems
         # less common.  If you specify multiple, it still just outputs a path,
@@ -267,36 +648,63 @@ async def download(
     else:
         dest_path = None
 
-    rc = 0
-    async with Cache(fresh_index=fresh, index_url=index_url) as cache:
-        for package_name in package_names:
-            package_name, operator, version = package_name.partition("==")
-            try:
-                package = await async_parse_index(
-                    package_name, cache, use_json=not nouse_json
-                )
-            except aiohttp.client_exceptions.ClientResponseError as e:
-                click.secho(f"Error: {package_name} got {e!r}", fg="red")
-                rc |= 2
-                continue
-
+    async with _make_cache(fresh_index=fresh, index_url=index_url) as cache:
+        packages, rc = await _async_parse_indexes(
+            cache, package_names, not nouse_json, max_concurrency
+        )
+        selected = []
+        for package_name, operator, version, package in packages:
             selected_versions = select_versions(package, operator, version)
 
             if verbose:
                 click.echo(f"check {package_name} {selected_versions}")
-
-            # any exception here sets the 1 bit
-            rc |= await async_download_many(
-                package,
-                versions=selected_versions,
-                dest=dest_path,
-                cache=cache,
-                verbose=verbose,
+            selected.append((package, selected_versions))
+
+        # All packages download at once, sharing one limit, rather than
+        # waiting for each package's downloads to finish before the next.
+        sem = asyncio.Semaphore(max_concurrency)
+        results = await asyncio.gather(
+            *(
+                async_download_many(
+                    package,
+                    versions=selected_versions,
+                    dest=dest_path,
+                    cache=cache,
+                    verbose=verbose,
+                    sem=sem,
+                )
+                for package, selected_versions in selected
             )
+        )
+        # any exception in there sets the 1 bit
+        for result in results:
+            rc |= result
 
     sys.exit(rc)
 
 
+def _reflink_copy(src: str, dst: str) -> None:
+    # Like shutil.copy2, but the data goes through copy_file_range
+    _fast_copy(Path(src), Path(dst))
+    shutil.copystat(src, dst)
+
+
+def _link_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        # e.g. EXDEV when dest is on another filesystem
+        _reflink_copy(src, dst)
+
+
+# copy_function for extract's copytree, by --copy-mode
+_COPY_FUNCTIONS: Dict[str, Callable[[str, str], Any]] = {
+    "reflink": _reflink_copy,
+    "link": _link_copy,
+    "copy": shutil.copy2,
+}
+
+
 @cli.command(help="Download/extract an sdist, print path on stdout")
 @click.option("--verbose", "-v", is_flag=True, type=bool)
 @click.option("--fresh", "-f", is_flag=True, type=bool)
@@ -305,6 +713,20 @@ async def download(
 @click.option(
     "--index-url", help="Alternate index url (uses HONESTY_INDEX_URL or pypi by default"
 )
+@click.option(
+    "--max-concurrency",
+    default=DEFAULT_CONCURRENCY,
+    type=int,
+    help="How many requests to have in flight at once",
+)
+@click.option(
+    "--copy-mode",
+    type=click.Choice(["reflink", "link", "copy"]),
+    default="reflink",
+    show_default=True,
+    help="How to populate --dest; link shares inodes with the extract cache, so "
+    "don't edit the results in place",
+)
 @click.argument("package_names", nargs=-1)
 @wrap_async
 async def extract(
@@ -313,20 +735,24 @@ async def extract(
     nouse_json: bool,
     dest: str,
     index_url: Optional[str],
+    max_concurrency: int,
+    copy_mode: str,
     package_names: List[str],
 ) -> None:
+    package_names = _expand_stdin(package_names)
     if dest and len(package_names) > 1:
         # select_versions() may also result in more than one, but that seems
         # less common.  If you specify multiple, it still just outputs a path,
         # but at least they're in the same order.
         raise click.ClickException("Cannot specify dest if more than one package")
 
-    async with Cache(fresh_index=fresh, index_url=index_url) as cache:
-        for package_name in package_names:
-            package_name, operator, version = package_name.partition("==")
-            package = await async_parse_index(
-                package_name, cache, use_json=not nouse_json
-            )
+    from .archive import extract_and_get_names
+
+    async with _make_cache(fresh_index=fresh, index_url=index_url) as cache:
+        packages, rc = await _async_parse_indexes(
+            cache, package_names, not nouse_json, max_concurrency
+        )
+        for package_name, operator, version, package in packages:
             selected_versions = select_versions(package, operator, version)
             if len(selected_versions) != 1:
                 raise click.ClickException(
@@ -337,13 +763,12 @@ async def extract(
                 click.echo(f"check {package_name} {selected_versions}")
 
             rel = package.releases[selected_versions[0]]
-            sdists = [f for f in rel.files if f.file_type == FileType.SDIST]
-            wheels = [f for f in rel.files if f.file_type == FileType.BDIST_WHEEL]
-            if not sdists and not wheels:
+            # The first sdist, or failing that the first wheel
+            candidates = rel.sdists or rel.wheels
+            if not candidates:
                 raise click.ClickException(f"{package.name} no sdists or wheels")
 
-            chosen = sdists + wheels
-            lp = await cache.async_fetch(pkg=package_name, url=chosen[0].url)
+            lp = await cache.async_fetch(pkg=package_name, url=candidates[0].url)
 
             archive_root, _ = extract_and_get_names(
                 lp, strip_top_level=True, patterns=("*.*",)
@@ -352,7 +777,11 @@ async def extract(
             subdirs = tuple(Path(archive_root).iterdir())
             if dest:
                 for subdir in subdirs:
-                    shutil.copytree(subdir, Path(dest, subdir.name))
+                    shutil.copytree(
+                        subdir,
+                        Path(dest, subdir.name),
+                        copy_function=_COPY_FUNCTIONS[copy_mode],
+                    )
                 inner_dest = dest
             else:
                 inner_dest = archive_root
@@ -365,6 +794,9 @@ async def extract(
             else:
                 print(inner_dest)
 
+    if rc != 0:
+        sys.exit(rc)
+
 
 @cli.command(help="Print age in days for a given release")
 @click.option("--verbose", "-v", is_flag=True, type=bool)
@@ -374,71 +806,146 @@ async def extract(
 @wrap_async
 async def age(verbose: bool, fresh: bool, base: str, package_names: List[str]) -> None:
     if base:
-        base_date = datetime.strptime(base, "%Y-%m-%d")
+        base_date = _utc_day(base, "--base")
     else:
-        base_date = datetime.utcnow()
-    base_date = base_date.replace(tzinfo=timezone.utc)
-
-    async with Cache(fresh_index=fresh) as cache:
-        for package_name in package_names:
-            package_name, operator, version = package_name.partition("==")
-            package = await async_parse_index(package_name, cache, use_json=True)
+        base_date = datetime.now(timezone.utc)
+    base_ts = base_date.timestamp()
+
+    package_names = _expand_stdin(package_names)
+    async with _make_cache(fresh_index=fresh) as cache:
+        # All the indexes at once, rather than one round trip after another
+        packages, rc = await _async_parse_indexes(cache, package_names, True)
+        for package_name, operator, version, package in packages:
             selected_versions = select_versions(package, operator, version)
             if len(package_names) > 1:
                 prefix = f"{package_name}=="
             else:
                 prefix = ""
 
+            # Written once per package rather than a print per version.
+            lines: List[str] = []
             for v in selected_versions:
-                if package.releases[v].files:
-                    t = min(
-                        x.upload_time
-                        for x in package.releases[v].files
-                        if x.upload_time is not None
-                    )
-                else:
-                    print(f"{prefix}{v}\t(no files)\t(no files)")
+                rel = package.releases[v]
+                t = rel.earliest_upload
+                if t is None:
+                    # Either no files at all, or an index without upload times
+                    lines.append(f"{prefix}{v}\t(no files)\t(no files)\n")
                     continue
 
-                assert t is not None
-
-                diff = base_date - t
-                days = diff.days + (diff.seconds / 86400.0)
-                tab = "\t"
-                print(
-                    f"{prefix}{v}\t{t.strftime('%Y-%m-%d')}\t{days:.2f}{tab + '(yanked)' if package.releases[v].yanked else ''}"
+                days = (base_ts - t.timestamp()) / 86400.0
+                # date().isoformat() is several times cheaper than strftime,
+                # which adds up for `foo==*` on a package with many releases.
+                yanked = "\t(yanked)" if rel.yanked else ""
+                lines.append(
+                    f"{prefix}{v}\t{t.date().isoformat()}\t{days:.2f}{yanked}\n"
                 )
+            sys.stdout.write("".join(lines))
+
+    if rc != 0:
+        sys.exit(rc)
+
+
+def _file_sha256(path: Path) -> str:
+    """
+    Hashes path a buffer at a time rather than reading the whole (possibly
+    very large) archive into memory first.
+    """
+    # Unbuffered, since both paths below read into a buffer of their own.
+    with open(path, "rb", buffering=0) as f:
+        if sys.version_info >= (3, 11):
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        # What file_digest does: one buffer, reused for every read
+        h = hashlib.sha256()
+        buf = bytearray(BUFFER_SIZE)
+        view = memoryview(buf)
+        while n := f.readinto(buf):
+            h.update(view[:n])
+        return h.hexdigest()
+
+
+def _walk_files(root: str) -> Iterator[Tuple[str, Dict[str, "os.DirEntry[str]"]]]:
+    """
+    Yields (dirpath, {name: entry}) for the non-directories in each directory
+    under root, like os.walk but keeping the DirEntry objects (and whatever
+    stat info they already have) instead of just names.
+    """
+    stack = [root]
+    while stack:
+        dirpath = stack.pop()
+        files = {}
+        try:
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        files[entry.name] = entry
+        except OSError:
+            # os.walk ignores these by default too
+            continue
+        yield dirpath, files
 
 
 @cli.command()
-def checkcache() -> None:
-    for dirpath, dirnames, filenames in os.walk(
-        os.path.expanduser("~/.cache/honesty/pypi")
-    ):
-        if "json" in filenames:
-            archives = [
-                f
-                for f in filenames
-                if not (f == "json" or f.startswith("json.") or f.endswith(".json"))
-            ]
-            obj = json.loads(Path(dirpath, "json").read_text())
+@click.option(
+    "--full",
+    is_flag=True,
+    type=bool,
+    help="Hash every archive, even ones unchanged since they were downloaded",
+)
+def checkcache(full: bool) -> None:
+    # Archives are hashed on a pool (sized by the group's -p) as the walk finds
+    # them, so hashing overlaps the rest of the walk; reads and hashing both
+    # release the GIL.
+    parallelism = click.get_current_context().find_root().params.get("parallelism")
+    # (dirpath, filename, expected sha256, future digest)
+    to_check: List[Tuple[str, str, str, Future[str]]] = []
+    root = os.path.expanduser("~/.cache/honesty/pypi")
+    with ThreadPoolExecutor(parallelism or None) as pool:
+        for dirpath, entries in _walk_files(root):
+            if "json" in entries:
+                # Whatever is left once releases are checked off is an orphan
+                archives = {
+                    f
+                    for f in entries
+                    if not (
+                        f == "json"
+                        or f.startswith(("json.", "index.html"))
+                        or f.endswith((".json", ".hdrs"))
+                        or ".parsed-" in f
+                    )
+                }
+                obj = json_loads(Path(dirpath, "json").read_bytes())
 
-            if "releases" not in obj:
-                if tuple(obj.keys()) != ("last_serial",):
-                    print(f"{dirpath}/json invalid {obj.keys()}")
-                continue
+                if "releases" not in obj:
+                    if tuple(obj.keys()) != ("last_serial",):
+                        print(f"{dirpath}/json invalid {obj.keys()}")
+                    continue
 
-            for lst in obj["releases"].values():
-                for i in lst:
-                    filename = os.path.basename(i["url"])
-                    if filename in archives:
-                        h = hashlib.sha256()
-                        h.update(Path(dirpath, filename).read_bytes())
-                        archives.remove(filename)
-                        if i["digests"]["sha256"] != h.hexdigest():
-                            click.secho(f"{dirpath}/{filename} bad digest", fg="red")
-            if archives:
-                print(f"{dirpath} orphans {archives}")
+                for lst in obj["releases"].values():
+                    for i in lst:
+                        filename = os.path.basename(i["url"])
+                        if filename in archives:
+                            archives.discard(filename)
+                            expected = i["digests"]["sha256"]
+                            path = Path(dirpath, filename)
+                            st = entries[filename].stat()
+                            # A truncated download doesn't need hashing to spot.
+                            if i.get("size") is not None and st.st_size != i["size"]:
+                                click.secho(f"{dirpath}/{filename} bad size", fg="red")
+                            # Already verified as it was downloaded, and it hasn't
+                            # been touched since.
+                            elif not full and recorded_digest(path, st) == expected:
+                                pass
+                            else:
+                                fut = pool.submit(_file_sha256, path)
+                                to_check.append((dirpath, filename, expected, fut))
+                if archives:
+                    print(f"{dirpath} orphans {sorted(archives)}")
+
+        for dirpath, filename, expected, fut in to_check:
+            if expected != fut.result():
+                click.secho(f"{dirpath}/{filename} bad digest", fg="red")
 
 
 @cli.command(
@@ -494,11 +1001,19 @@ def deps(
     nouse_json: bool,
     requirement_file: List[str],
 ) -> None:
-    new_have = []
+    from .deps import DepWalker, POOL, print_deps, print_flat_deps
+
+    # This is the group's -p; presumably nothing has run on the pool yet...
+    parallelism = click.get_current_context().find_root().params.get("parallelism")
+    if parallelism:
+        POOL._max_workers = parallelism
+
+    # Canonicalized once here, since the callback below runs for every
+    # package the walk picks a version for.
+    have_versions: Dict[str, str] = {}
     for h in have:
         k, _, v = h.partition("==")
-        new_have.append(f"{canonicalize_name(k)}=={v}")
-    have = new_have
+        have_versions.setdefault(canonicalize_name(k), v)
 
     # Command above is called "list" :(
     reqs = [i for i in reqs]
@@ -514,38 +1029,36 @@ def deps(
 
     trim_newer: Optional[datetime]
     if historical:
-        trim_newer = datetime.strptime(historical, "%Y-%m-%d").replace(
-            tzinfo=timezone.utc
-        )
+        trim_newer = _utc_day(historical, "--historical")
     else:
         trim_newer = None
 
     def current_versions_callback(p: str) -> Optional[str]:
-        assert is_canonical(p)
-        for x in have:
-            k, _, v = x.partition("==")
-            if canonicalize_name(k) == p:
-                # TODO canonicalize earlier
-                return v
-        return None
+        # The walker only passes canonical names (and asserts as much itself)
+        return have_versions.get(p)
 
     # TODO something that understands pep 517 requirements for building
     # TODO move this out of cmdline into deps.py
 
-    seen: Set[Tuple[str, Optional[Tuple[str, ...]], Version]] = set()
+    seen: Set[int] = set()
     assert python_version.count(".") == 2
-    walker = DepWalker(
-        python_version,
-        sys_platform,
-        only_first=pick,
-        trim_newer=trim_newer,
-        use_json=not nouse_json,
-    )
-    walker.enqueue(reqs)
-    deptree = walker.walk(
-        include_extras,
-        current_versions_callback=current_versions_callback,
-    )
+    # One Cache for the whole walk, so index and sdist fetches share a pool
+    with _make_cache() as cache:
+        walker = DepWalker(
+            python_version,
+            sys_platform,
+            only_first=pick,
+            trim_newer=trim_newer,
+            cache=cache,
+            use_json=not nouse_json,
+        )
+        walker.enqueue(reqs)
+        # Things already installed are likely somewhere in the tree
+        walker.prefetch(have_versions)
+        deptree = walker.walk(
+            include_extras,
+            current_versions_callback=current_versions_callback,
+        )
     with keke.kev("print"):
         if pick:
             # TODO this is completely wrong
@@ -567,7 +1080,10 @@ def deps(
 async def revs(
     verbose: bool, url_only: bool, fresh: bool, try_order: str, package_names: List[str]
 ) -> None:
-    async with Cache(fresh_index=fresh) as cache:
+    from .archive import extract_and_get_names
+    from .vcs import CloneAnalyzer, extract2
+
+    async with _make_cache(fresh_index=fresh) as cache:
         for package_name in package_names:
             url = None
             if "@" in package_name:
@@ -591,28 +1107,49 @@ async def revs(
                 print(f"{package.name}: {url}")
                 continue
 
-            ca = CloneAnalyzer(url, verbose=verbose)
+            # The clone, downloads and extractions don't depend on each other,
+            # so they overlap (the clone and extractions in threads) and only
+            # find_best_match, which needs both, goes a version at a time.
+            loop = asyncio.get_running_loop()
+            clone = loop.run_in_executor(
+                None, functools.partial(CloneAnalyzer, url, verbose=verbose)
+            )
 
             selected_versions = select_versions(package, operator, version)
+            picks: List[Tuple[Version, FileEntry, str]] = []
             for sv in selected_versions:
                 # TODO support verssion '*' and such better
                 rel = package.releases[sv]
-                sdists = [f for f in rel.files if f.file_type == FileType.SDIST]
-                type_suffix = "sdist"
-                if not sdists:
+                if rel.sdists:
+                    picks.append((sv, rel.sdists[0], "sdist"))
+                else:
                     # These are generally ordered by python version, so this
                     # makes us prefer a more current release, no 3to2
-                    sdists = [
-                        f for f in rel.files if f.file_type == FileType.BDIST_WHEEL
-                    ]
-                    type_suffix = "wheel"
-
-                lp = await cache.async_fetch(pkg=package_name, url=sdists[0].url)
-
-                # TODO: More than just *.py...
-                archive_root, names = extract_and_get_names(
-                    lp, strip_top_level=True, patterns=("*.*",)
+                    picks.append((sv, rel.wheels[0], "wheel"))
+
+            ca, *local_paths = await asyncio.gather(
+                clone,
+                *(
+                    cache.async_fetch(pkg=package_name, url=fe.url)
+                    for _, fe, _ in picks
+                ),
+            )
+            # TODO: More than just *.py...
+            extractions = [
+                loop.run_in_executor(
+                    None,
+                    functools.partial(
+                        extract_and_get_names,
+                        lp,
+                        strip_top_level=True,
+                        patterns=("*.*",),
+                    ),
                 )
+                for lp in local_paths
+            ]
+
+            for (sv, _, type_suffix), extraction in zip(picks, extractions):
+                archive_root, names = await extraction
 
                 # This makes an assumption the repo and tree are set up the same (no
                 # subdir)
@@ -629,6 +1166,19 @@ async def revs(
                     print("  no match")
 
 
+def _select_all_versions(
+    packages: List[Tuple[str, str, str, Package]]
+) -> List[Tuple[str, Package, List[Version]]]:
+    """
+    select_versions for each of _parse_indexes' results, all up front, so that
+    whatever they need can be fetched together.
+    """
+    return [
+        (package_name, package, select_versions(package, operator, version))
+        for package_name, operator, version, package in packages
+    ]
+
+
 def select_versions(package: Package, operator: str, selector: str) -> List[Version]:
     """
     Given operator='==' and selector='*' or '2.0', return a list of the matching
@@ -641,16 +1191,15 @@ def select_versions(package: Package, operator: str, selector: str) -> List[Vers
         raise click.ClickException("Only '==' is supported")
 
     if selector == "":
-        # latest; we have a function called `list`
-        version = [
-            x for x in package.releases.keys() if not package.releases[x].yanked
-        ][-1]
-        return [version]
+        # latest
+        if not package.unyanked_versions:
+            raise click.ClickException(f"Only yanked releases for {package.name}")
+        return [package.unyanked_versions[-1]]
     elif selector == "*":
         # we have a function called `list`
-        return [x for x in package.releases.keys() if not package.releases[x].yanked]
+        return [*package.unyanked_versions]
     else:
-        pv = Version(selector)
+        pv = _parse_version(selector)
         if pv not in package.releases:
             raise click.ClickException(
                 f"The version {selector} does not exist for {package.name}"
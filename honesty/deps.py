@@ -1,3 +1,4 @@
+import functools
 import logging
 import os
 import tarfile
@@ -21,7 +22,7 @@ from pkginfo.wheel import Wheel
 from seekablehttpfile import SeekableHttpFile
 
 from .cache import Cache
-from .releases import FileType, Package, parse_index
+from .releases import _parse_version, FileType, Package, parse_index
 
 LOG = logging.getLogger(__name__)
 VersionCallback = Callable[[str], Optional[str]]
@@ -137,9 +138,22 @@ class DepWalker:
         for i in reqs:
             req = Requirement(i)
             name = canonicalize_name(req.name)
-            if name not in self.futures:
-                self.futures[name] = POOL.submit(self.fetch, name)
-            self.queue.append((self.root, name, self.futures[name], req))
+            self.queue.append((self.root, name, self._future(name), req))
+
+    @ktrace("len(names)")
+    def prefetch(self, names: Iterable[str]) -> None:
+        """
+        Start fetching indexes for names that will probably turn up during the
+        walk (e.g. what's already installed), without adding them to it, so
+        they don't wait for their parent's metadata to be read first.
+        """
+        for name in names:
+            self._future(canonicalize_name(name))
+
+    def _future(self, name: str) -> "Future[Package]":
+        if name not in self.futures:
+            self.futures[name] = POOL.submit(self.fetch, name)
+        return self.futures[name]
 
     @ktrace("pkg")
     def fetch(self, pkg: str) -> Package:
@@ -157,125 +171,121 @@ class DepWalker:
 
         key: KeyType
 
-        with Cache() as cache:
-            while self.queue:
-                parent, name, fut, req = self.queue.pop(0)
-                assert parent is not None
-                if parent is not None:
-                    parent_str = parent.name
-                else:
-                    parent_str = "(root)"
-                LOG.info(f"dequeue {req!r} for {parent_str}")
-
-                # The python_version marker is by far the most widely-used.
-                if req.marker and not self._do_markers_match(req.marker):
-                    LOG.debug(f"Skip {req.name} {req.marker}")
-                    continue
-
-                with kev(".result", req=str(req)):
-                    package = fut.result()
-
-                with kev("pick_a_version", req=str(req)):
-                    v = self._pick_a_version(
-                        req,
-                        package,
-                        already_chosen,
-                        current_versions_callback,
-                    )
-                LOG.debug(f"Chose {v}")
+        # Sdists come through the same Cache (and so the same connection pool)
+        # as the indexes fetched by _future.
+        cache = self.cache
+        while self.queue:
+            parent, name, fut, req = self.queue.pop(0)
+            assert parent is not None
+            if parent is not None:
+                parent_str = parent.name
+            else:
+                parent_str = "(root)"
+            LOG.info("dequeue %r for %s", req, parent_str)
 
-                if v in package.releases:
-                    has_sdist = any(
-                        fe.file_type == FileType.SDIST
-                        for fe in package.releases[v].files
-                    )
-                    # TODO: consider eggs or bdist_dumb as valid?  Can pip still use them?
-                    # TODO: check only for matching-arch wheels?
-                    has_bdist = any(
-                        fe.file_type == FileType.BDIST_WHEEL
-                        for fe in package.releases[v].files
-                    )
+            # The python_version marker is by far the most widely-used.
+            if req.marker and not self._do_markers_match(req.marker):
+                LOG.debug("Skip %s %s", req.name, req.marker)
+                continue
 
-                    t: Tuple[str, ...] = tuple(sorted(req.extras))
-                    assert is_canonical(package.name)
-                    key = (package.name, v, t)
-                else:
-                    # Reuse existing version, even if it doesn't exist
-                    has_sdist = None
-                    has_bdist = None
-                    # TODO verify this is canonical
-                    assert is_canonical(req.name)
-                    key = (req.name, v, None)
-
-                cur = already_chosen.get(key[0])
-                if cur is not None and cur != key[1]:
-                    LOG.warning(f"Multiple versions for {key[0]}: {cur} and {key[1]}")
-                    self.known_conflicts.add(key[0])
-                already_chosen[key[0]] = key[1]
-
-                node = self.nodes.get(key)
-                # req.extras is Set[Any] for some reason
-                req_extras: Set[str] = req.extras
-                if node is None:
-                    # No edges to it yet
-                    node = DepNode(
-                        package.name,
-                        v,
-                        [],
-                        has_sdist=has_sdist,
-                        has_bdist=has_bdist,
-                        dep_extras=req_extras,
-                    )
-                    self.nodes[key] = node
+            with kev(".result", req=str(req)):
+                package = fut.result()
 
-                if parent is None:
-                    parent = self.root
-                else:
-                    parent.deps.append(
-                        DepEdge(
-                            node,
-                            str(req.specifier),
-                            req.marker,
-                        )
-                    )
+            with kev("pick_a_version", req=str(req)):
+                v = self._pick_a_version(
+                    req,
+                    package,
+                    already_chosen,
+                    current_versions_callback,
+                )
+            LOG.debug("Chose %s", v)
 
-                if node.done:
-                    continue
+            if v in package.releases:
+                has_sdist = bool(package.releases[v].sdists)
+                # TODO: consider eggs or bdist_dumb as valid?  Can pip still use them?
+                # TODO: check only for matching-arch wheels?
+                has_bdist = bool(package.releases[v].wheels)
 
-                if self.only_first:
-                    break
+                t: Tuple[str, ...] = tuple(sorted(req.extras))
+                assert is_canonical(package.name)
+                key = (package.name, v, t)
+            else:
+                # Reuse existing version, even if it doesn't exist
+                has_sdist = None
+                has_bdist = None
+                # TODO verify this is canonical
+                assert is_canonical(req.name)
+                key = (req.name, v, None)
+
+            cur = already_chosen.get(key[0])
+            if cur is not None and cur != key[1]:
+                LOG.warning(f"Multiple versions for {key[0]}: {cur} and {key[1]}")
+                self.known_conflicts.add(key[0])
+            already_chosen[key[0]] = key[1]
+
+            node = self.nodes.get(key)
+            # req.extras is Set[Any] for some reason
+            req_extras: Set[str] = req.extras
+            if node is None:
+                # No edges to it yet
+                node = DepNode(
+                    package.name,
+                    v,
+                    [],
+                    has_sdist=has_sdist,
+                    has_bdist=has_bdist,
+                    dep_extras=req_extras,
+                )
+                self.nodes[key] = node
 
-                # DO STUFF
-                with kev("fetch_single_deps", pkg=package.name):
-                    deps = self._fetch_single_deps(package, v, cache)
-                LOG.info(f"deps {deps} {req.extras}")
-                for d in deps:
-                    dep_req = Requirement(d)
-
-                    # This is nuanced, and could use a lot more (any) tests.
-                    # This handles extras_require for deps when the current
-                    # package (req) specifies e.g. pkg[foo] and now we need to
-                    # find pkg's extras_require for foo.  Setuptools only
-                    # appears to use == for these, which makes it a little
-                    # easier.
-                    extra_str = None
-                    if dep_req.marker:
-                        for t in dep_req.marker._markers:
-                            if str(t[0]) == "extra":
-                                assert str(t[1]) == "=="
-                                extra_str = str(t[2])
-
-                    if extra_str is None or (
-                        include_extras and extra_str in req.extras
-                    ):
-                        name = canonicalize_name(dep_req.name)
-                        if name not in self.futures:
-                            self.futures[name] = POOL.submit(self.fetch, name)
-                        self.queue.append((node, name, self.futures[name], dep_req))
-                        LOG.info(
-                            f"enqueue {dep_req!r} for {node!r} {extra_str=} {req.extras=}"
-                        )
-                node.done = True
+            if parent is None:
+                parent = self.root
+            else:
+                parent.deps.append(
+                    DepEdge(
+                        node,
+                        str(req.specifier),
+                        req.marker,
+                    )
+                )
+
+            if node.done:
+                continue
+
+            if self.only_first:
+                break
+
+            # DO STUFF
+            with kev("fetch_single_deps", pkg=package.name):
+                deps = self._fetch_single_deps(package, v, cache)
+            LOG.info("deps %s %s", deps, req.extras)
+            for d in deps:
+                dep_req = Requirement(d)
+
+                # This is nuanced, and could use a lot more (any) tests.
+                # This handles extras_require for deps when the current
+                # package (req) specifies e.g. pkg[foo] and now we need to
+                # find pkg's extras_require for foo.  Setuptools only
+                # appears to use == for these, which makes it a little
+                # easier.
+                extra_str = None
+                if dep_req.marker:
+                    for t in dep_req.marker._markers:
+                        if str(t[0]) == "extra":
+                            assert str(t[1]) == "=="
+                            extra_str = str(t[2])
+
+                if extra_str is None or (include_extras and extra_str in req.extras):
+                    name = canonicalize_name(dep_req.name)
+                    self.queue.append((node, name, self._future(name), dep_req))
+                    LOG.info(
+                        "enqueue %r for %r extra_str=%r req.extras=%r",
+                        dep_req,
+                        node,
+                        extra_str,
+                        req.extras,
+                    )
+            node.done = True
 
         assert self.root is not None
         return self.root
@@ -333,7 +343,7 @@ class DepWalker:
         # Different wheels can have different deps.  We're choosing one arbitrarily.
         for fe in package.releases[v].files:
             if fe.file_type == FileType.BDIST_WHEEL:
-                LOG.info(f"wheel {fe.url} {fe.size}")
+                LOG.info("wheel %s %s", fe.url, fe.size)
                 if fe.size is not None and fe.size > 20000000:
                     # Gigantic wheels we'll pay the remote read penalty
                     # the 'or ()' is needed for numpy
@@ -452,6 +462,17 @@ def read_metadata_remote_wheel(url: str) -> Sequence[str]:
     raise ValueError("No metadata")
 
 
+@functools.lru_cache(maxsize=4096)
+def _python_matches(requires_python: str, python_version: Version) -> bool:
+    """
+    Whether python_version satisfies a requires_python string, remembered
+    because most releases of a package (and many packages) repeat the same
+    few strings, and SpecifierSet parses them with regexes every time.
+    InvalidSpecifier is not cached.
+    """
+    return python_version in SpecifierSet(requires_python)
+
+
 def _find_compatible_version(
     package: Package,
     specifiers: SpecifierSet,
@@ -485,15 +506,15 @@ def _find_compatible_version(
             requires_python = None
             for fe in v.files:
                 if fe.requires_python:
-                    requires_python = SpecifierSet(fe.requires_python)
+                    requires_python = fe.requires_python
                     break
 
             # LOG.debug(f"CHECK {package.name} {python_version} against {requires_python}: {k}")
-            if not requires_python or python_version in requires_python:
+            if not requires_python or _python_matches(requires_python, python_version):
                 LOG.debug("  include %s", k)
                 possible.append(k)
         except InvalidSpecifier as e:
-            LOG.debug(f"  bad specifier: {e!r}")
+            LOG.debug("  bad specifier: %r", e)
 
     if not possible:
         raise ValueError(f"{package.name} incompatible with {python_version}")
@@ -503,7 +524,7 @@ def _find_compatible_version(
     cur = current_versions_callback and current_versions_callback(package.name)
     cur_v: Optional[Version] = None
     if cur:
-        cur_v = Version(cur)
+        cur_v = _parse_version(cur)
     if cur_v and cur_v not in package.releases:
         possible.append(cur_v)
 
@@ -518,13 +539,14 @@ def _find_compatible_version(
     # This prioritizes keeping already_chosen (this walk) version, then the
     # currently-installed (--have) version, then the most recent version, then
     # the version itself.  We need the version to return, but it should have
-    # started in sorted order so we can sort on index.
-    xform_possible: List[Tuple[bool, bool, int, Version]] = sorted(
+    # started in sorted order so we can compare on index.  Only the best one
+    # is needed, so max rather than sorting them all.
+    best: Tuple[bool, bool, int, Version] = max(
         (p == ac, p == cur_v, i, p) for (i, p) in enumerate(possible)
     )
-    LOG.debug(f"  possible {xform_possible!r}")
+    LOG.debug("  possible %r best %r", possible, best)
 
-    return xform_possible[-1][3]
+    return best[3]
 
 
 class Extras:
@@ -542,16 +564,10 @@ class Extras:
         return other in self.extras
 
 
-def print_flat_deps(
-    deps: DepNode, seen: Set[Tuple[str, Optional[Tuple[str, ...]], Version]]
-) -> None:
+def print_flat_deps(deps: DepNode, seen: Set[int]) -> None:
     # Simple postorder, assumes no cycles (fixtures/testtools)
     for x in deps.deps:
-        key = (
-            x.target.name,
-            tuple(sorted(x.target.dep_extras)) if x.target.dep_extras else None,
-            x.target.version,
-        )
+        key = id(x.target)
         flag = key in seen
         seen.add(key)
 
@@ -567,19 +583,20 @@ def print_flat_deps(
 
 def print_deps(
     deps: DepNode,
-    seen: Set[Tuple[str, Optional[Tuple[str, ...]], Version]],
+    seen: Set[int],
     known_conflicts: Set[str],
     depth: int = 0,
 ) -> None:
+    """
+    seen holds the id() of nodes already printed.  DepWalker makes one node
+    per (name, version, extras), so that's the same as comparing those, but
+    only hashes an int rather than a tuple with a Version in it.
+    """
     prefix = ". " * depth
     for x in deps.deps:
         # TODO display whether install or build dep, and whether pin disallows
         # current version, has compatible bdist, no sdist, etc
-        key = (
-            x.target.name,
-            tuple(sorted(x.target.dep_extras)) if x.target.dep_extras else None,
-            x.target.version,
-        )
+        key = id(x.target)
         dep_extras = (
             f"[{', '.join(sorted(x.target.dep_extras))}]" if x.target.dep_extras else ""
         )
@@ -589,14 +606,14 @@ def print_deps(
                 + click.style(
                     x.target.name,
                     fg="magenta"
-                    if key[0] in known_conflicts and x.constraints
+                    if x.target.name in known_conflicts and x.constraints
                     else None,
                 )
                 + f"{dep_extras} (=={x.target.version}) (already listed){' ; ' + str(x.markers) if x.markers else ''} via "
                 + click.style(x.constraints or "*", fg="yellow")
             )
         else:
-            if key[0] in known_conflicts and x.constraints:
+            if x.target.name in known_conflicts and x.constraints:
                 # conflicting decision
                 color = "magenta"
             else:
@@ -1,19 +1,21 @@
+import asyncio
 import enum
+import functools
 import json
 import logging
 import re
 import urllib.parse
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from datetime import datetime, timezone
 from html.parser import HTMLParser
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Sequence, Tuple
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 from keke import ktrace
 
 from packaging.version import InvalidVersion, Version
 
-from .cache import Cache
+from .cache import atomic_writer, Cache
 
 try:
     import orjson as json  # type: ignore[no-redef]  # noqa: F811
@@ -32,12 +34,24 @@ NUMERIC_VERSION = re.compile(
     r"(?:|-.*))?$"
 )
 
-ISO8601_FORMAT = "%Y-%m-%dT%H:%M:%S"
+# Bump whenever Package or the things it contains change shape, so stale
+# files from _load_parsed are ignored.
+PARSED_CACHE_VERSION = 2
 
 
 SDIST_EXTENSIONS = (".tgz", ".tar.gz", ".zip", ".tar.bz2")
 
 
+@functools.lru_cache(maxsize=4096)
+def _parse_version(s: str) -> Version:
+    """
+    Version(s), but remembered.  Every file in a release repeats the same
+    version string, and dep walks see the same pins over and over; Version is
+    immutable so sharing instances is fine.  InvalidVersion is not cached.
+    """
+    return Version(s)
+
+
 # This list matches warehouse/packaging/models.py with the addition of UNKNOWN.
 #
 # Platform (in the case of bdist_dumb) is not currently stored anywhere but
@@ -117,6 +131,12 @@ class FileEntry:
     yanked: Optional[str] = None
     # TODO extract upload date?
 
+    @property
+    def sha256(self) -> Optional[str]:
+        """The hex digest from checksum, if it's a sha256."""
+        algo, _, digest = self.checksum.partition("=")
+        return digest if algo == "sha256" else None
+
     @classmethod
     def from_attrs(cls, attrs: List[Tuple[str, Optional[str]]]) -> "FileEntry":
         """
@@ -166,13 +186,15 @@ def parse_time(t: str) -> datetime:
     """Returns a parsed time with optional fractional seconds."""
     # Timestamps before ~2009-02-16 do not have fractional seconds.
     t = t.rstrip("Z")
-    fmt, _, fractional = t.partition(".")
+    whole, _, fractional = t.partition(".")
 
-    # This makes it microseconds
+    # This makes it microseconds, which is also the only length (besides 3)
+    # that fromisoformat accepts before 3.11.  fromisoformat is much cheaper
+    # than strptime, and this runs for every file in a json index.
     fractional = fractional[:6].ljust(6, "0")
 
-    return datetime.strptime(t.split(".")[0], ISO8601_FORMAT).replace(
-        microsecond=int(fractional), tzinfo=timezone.utc
+    return datetime.fromisoformat(f"{whole}.{fractional}").replace(
+        tzinfo=timezone.utc
     )
 
 
@@ -184,6 +206,36 @@ class PackageRelease:
     requires: Optional[List[str]] = None
     yanked: Optional[str] = None
 
+    @functools.cached_property
+    def earliest_upload(self) -> Optional[datetime]:
+        """
+        When the first of files was uploaded, or None if none of them say.
+        Computed on first use, like Package.unyanked_versions.
+        """
+        return min(
+            (f.upload_time for f in self.files if f.upload_time is not None),
+            default=None,
+        )
+
+    @functools.cached_property
+    def sdists(self) -> Tuple[FileEntry, ...]:
+        """The files that are sdists, in files order."""
+        return tuple(f for f in self.files if f.file_type == FileType.SDIST)
+
+    @functools.cached_property
+    def wheels(self) -> Tuple[FileEntry, ...]:
+        """The files that are wheels, in files order."""
+        return tuple(f for f in self.files if f.file_type == FileType.BDIST_WHEEL)
+
+    @functools.cached_property
+    def other(self) -> Tuple[FileEntry, ...]:
+        """The files that are neither sdists nor wheels (eggs, bdist_dumb, ...)."""
+        return tuple(
+            f
+            for f in self.files
+            if f.file_type not in (FileType.SDIST, FileType.BDIST_WHEEL)
+        )
+
 
 @dataclass
 class Package:
@@ -193,6 +245,14 @@ class Package:
     home_page: Optional[str] = None
     project_urls: Optional[Dict[str, str]] = None
 
+    @functools.cached_property
+    def unyanked_versions(self) -> Tuple[Version, ...]:
+        """
+        Versions that aren't yanked, in increasing order.  Computed on first
+        use, so don't change releases (or their yanked) after that.
+        """
+        return tuple(v for v, r in self.releases.items() if not r.yanked)
+
 
 def remove_suffix(basename: str) -> str:
     suffixes = [
@@ -259,16 +319,29 @@ def parse_index(
     if use_json:
         # This will redirect away from canonical name if they differ
         url = urllib.parse.urljoin(cache.json_index_url, f"../pypi/{pkg}/json")
-        package = _load_json(pkg, cache.fetch(pkg, url=url), strict=strict)
+        package = _load_parsed(
+            _load_json, pkg, cache.fetch(pkg, url=url), cache, strict=strict
+        )
     else:
-        package = _load_html(pkg, cache.fetch(pkg, url=None), strict=strict)
+        package = _load_parsed(
+            _load_html, pkg, cache.fetch(pkg, url=None), cache, strict=strict
+        )
 
     return package
 
 
 async def async_parse_index(
-    pkg: str, cache: Cache, strict: bool = False, use_json: bool = False
+    pkg: str,
+    cache: Cache,
+    strict: bool = False,
+    use_json: bool = False,
+    revalidate: Optional[bool] = None,
 ) -> Package:
+    """
+    Like parse_index, but fetching with the cache's session.  Unlike the sync
+    version, a cached index is only revalidated when the cache has fresh_index
+    set, unless revalidate says otherwise.
+    """
     package: Optional[Package]
 
     # The input order of releases in both cases is not correct; so we sort at
@@ -276,13 +349,145 @@ async def async_parse_index(
     if use_json:
         # This will redirect away from canonical name if they differ
         url = urllib.parse.urljoin(cache.json_index_url, f"../pypi/{pkg}/json")
-        package = _load_json(pkg, await cache.async_fetch(pkg, url=url), strict=strict)
+        path = await cache.async_fetch(pkg, url=url, revalidate=revalidate)
+        package = _load_parsed(_load_json, pkg, path, cache, strict=strict)
     else:
-        package = _load_html(pkg, await cache.async_fetch(pkg, url=None), strict=strict)
+        path = await cache.async_fetch(pkg, url=None, revalidate=revalidate)
+        package = _load_parsed(_load_html, pkg, path, cache, strict=strict)
+
+    return package
+
 
+async def async_parse_indexes(
+    pkgs: Sequence[str],
+    cache: Cache,
+    strict: bool = False,
+    use_json: bool = False,
+    concurrency: Optional[int] = None,
+    revalidate: Optional[bool] = None,
+) -> List[Union[Package, BaseException]]:
+    """
+    Like async_parse_index for several packages at once, returned in the same
+    order.  The requests (which are conditional when freshening an index) run
+    concurrently over the session's pooled connections rather than one
+    round-trip after another, but no more than `concurrency` at once if given.
+
+    As with asyncio.gather(return_exceptions=True), a package that fails has
+    its exception in its place, so one missing name doesn't lose the rest.
+    """
+    sem = asyncio.Semaphore(concurrency or len(pkgs) or 1)
+
+    async def _bound(pkg: str) -> Package:
+        async with sem:
+            return await async_parse_index(
+                pkg, cache, strict=strict, use_json=use_json, revalidate=revalidate
+            )
+
+    return await asyncio.gather(
+        *(_bound(pkg) for pkg in pkgs),
+        return_exceptions=True,
+    )
+
+
+@ktrace("pkg")
+def _load_parsed(
+    loader: Callable[..., Package],
+    pkg: str,
+    path: Path,
+    cache: Cache,
+    strict: bool,
+) -> Package:
+    """
+    Returns loader(pkg, path, strict=strict), but remembers the result next to
+    path so that as long as the index hasn't changed (say, the server said 304)
+    the next run doesn't have to parse it again.  It's keyed by the digest
+    recorded when the index was downloaded, so a new body (new etag) misses.
+
+    That's stored as plain json rather than a pickle, since the cache dir may
+    be shared and loading it shouldn't be able to run anything.
+    """
+    digest = cache.get_digest(path)
+    if digest is None:
+        # Fetched before digests were recorded (or the file was touched since).
+        # Hashing is much cheaper than parsing, and only needed once.
+        digest = cache.record_digest(path)
+
+    parsed_path = path.with_name(
+        f"{path.name}.parsed-{PARSED_CACHE_VERSION}-{int(strict)}.json"
+    )
+    try:
+        with open(parsed_path, "rb") as f:
+            obj = json.loads(f.read())
+        if obj["digest"] == digest and obj["name"] == pkg:
+            return _package_from_json(obj)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        # Torn, or from an incompatible version; just parse again.
+        LOG.debug("Ignoring %s: %r", parsed_path, e)
+
+    package = loader(pkg, path, strict=strict)
+    data = json.dumps({"digest": digest, **_package_to_json(package)})
+    with atomic_writer(parsed_path) as f:
+        # orjson gives bytes, the stdlib str
+        f.write(data if isinstance(data, bytes) else data.encode())
     return package
 
 
+def _package_to_json(package: Package) -> Dict[str, Any]:
+    """
+    The fields of package as json-able values; see _package_from_json.
+    """
+    return {
+        "name": package.name,
+        "requires": package.requires and [*package.requires],
+        "home_page": package.home_page,
+        "project_urls": package.project_urls,
+        "releases": [
+            {
+                "version": rel.version,
+                "requires": rel.requires,
+                "yanked": rel.yanked,
+                "files": [
+                    {
+                        **{f.name: getattr(fe, f.name) for f in fields(fe)},
+                        "file_type": fe.file_type.value,
+                        "upload_time": fe.upload_time and fe.upload_time.isoformat(),
+                    }
+                    for fe in rel.files
+                ],
+            }
+            for rel in package.releases.values()
+        ],
+    }
+
+
+def _package_from_json(obj: Dict[str, Any]) -> Package:
+    releases: Dict[Version, PackageRelease] = {}
+    for r in obj["releases"]:
+        files = []
+        for f in r["files"]:
+            f["file_type"] = FileType(f["file_type"])
+            if f["upload_time"] is not None:
+                f["upload_time"] = datetime.fromisoformat(f["upload_time"])
+            files.append(FileEntry(**f))
+        pv = _parse_version(r["version"])
+        releases[pv] = PackageRelease(
+            version=r["version"],
+            parsed_version=pv,
+            files=files,
+            requires=r["requires"],
+            yanked=r["yanked"],
+        )
+    return Package(
+        name=obj["name"],
+        releases=releases,
+        requires=obj["requires"],
+        home_page=obj["home_page"],
+        project_urls=obj["project_urls"],
+    )
+
+
 @ktrace("pkg", "path.stat().st_size")
 def _load_html(pkg: str, path: Path, strict: bool = True) -> Package:
     package = Package(name=pkg, releases={})
@@ -294,7 +499,7 @@ def _load_html(pkg: str, path: Path, strict: bool = True) -> Package:
     for fe in gatherer.entries:
         v = fe.version
         try:
-            pv = Version(v)
+            pv = _parse_version(v)
         except InvalidVersion as e:
             LOG.debug(f"Skip version {pkg}=={v}: {e!r}")
             continue
@@ -335,7 +540,7 @@ def _load_json(pkg: str, path: Path, strict: bool = True) -> Package:
             # up in the simple index either.
             continue
         try:
-            pv = Version(k)
+            pv = _parse_version(k)
         except InvalidVersion as e:
             LOG.debug(f"Skip version {pkg}=={k}: {e!r}")
             continue
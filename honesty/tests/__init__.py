@@ -1,7 +1,21 @@
+from .api import ApiTest
 from .archive import ArchiveTest
 from .cache import CacheTest
 from .checker import CheckerTest
-from .cmdline import DownloadTest, ExtractTest, LicenseTest
+from .cmdline import (
+    AgeTest,
+    CopyModeTest,
+    DataclassDefaultTest,
+    DownloadTest,
+    ExtractTest,
+    FileSha256Test,
+    ImportTest,
+    LicenseTest,
+    ListTest,
+    ParseIndexesTest,
+    ReuseSessionTest,
+    SelectVersionsTest,
+)
 from .deps import (
     ConvertSdistRequiresTest,
     DepWalkerTest,
@@ -14,12 +28,22 @@ from .releases import ReleasesTest
 from .revs import RevsTest
 
 __all__ = [
+    "ApiTest",
     "ArchiveTest",
     "CacheTest",
     "CheckerTest",
     "LicenseTest",
+    "AgeTest",
+    "CopyModeTest",
+    "DataclassDefaultTest",
     "DownloadTest",
     "ExtractTest",
+    "FileSha256Test",
+    "ImportTest",
+    "ListTest",
+    "ParseIndexesTest",
+    "ReuseSessionTest",
+    "SelectVersionsTest",
     "ConvertSdistRequiresTest",
     "EnvironmentMarkersTest",
     "FindCompatibleVersionTest",
@@ -0,0 +1,108 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Optional
+from unittest import mock
+
+from ..api import _fast_copy, async_download_many
+from ..releases import Package
+from .helpers import make_file_entry, make_package, make_release
+
+
+class SlowCache:
+    def __init__(self, path: str) -> None:
+        self.path = Path(path)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def async_fetch(
+        self, pkg: str, url: Optional[str], expected_sha256: Optional[str] = None
+    ) -> Path:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        assert url is not None
+        return self.path / url
+
+
+def _make_package(n: int) -> Package:
+    return make_package(
+        "foo",
+        [
+            make_release(f"0.{i}", [make_file_entry(f"foo-0.{i}.tar.gz")])
+            for i in range(n)
+        ],
+    )
+
+
+class ApiTest(unittest.TestCase):
+    def test_download_many_concurrency(self) -> None:
+        package = _make_package(10)
+        with tempfile.TemporaryDirectory() as d:
+            cache = SlowCache(d)
+            rc = asyncio.run(
+                async_download_many(
+                    package,
+                    versions=list(package.releases),
+                    dest=None,
+                    cache=cache,  # type: ignore[arg-type]
+                    concurrency=3,
+                )
+            )
+            self.assertEqual(0, rc)
+            self.assertEqual(3, cache.max_in_flight)
+
+    def test_download_many_shared_semaphore(self) -> None:
+        package = _make_package(10)
+
+        async def inner(cache: SlowCache) -> int:
+            sem = asyncio.Semaphore(4)
+            results = await asyncio.gather(
+                *(
+                    async_download_many(
+                        package,
+                        versions=list(package.releases),
+                        dest=None,
+                        cache=cache,  # type: ignore[arg-type]
+                        sem=sem,
+                    )
+                    for _ in range(3)
+                )
+            )
+            return sum(results)
+
+        with tempfile.TemporaryDirectory() as d:
+            cache = SlowCache(d)
+            self.assertEqual(0, asyncio.run(inner(cache)))
+            self.assertEqual(4, cache.max_in_flight)
+
+    def test_fast_copy(self) -> None:
+        with tempfile.TemporaryDirectory() as d:
+            src = Path(d, "src")
+            dst = Path(d, "dst")
+            src.write_bytes(b"x" * 100000)
+            _fast_copy(src, dst)
+            self.assertEqual(src.read_bytes(), dst.read_bytes())
+
+    @unittest.skipUnless(hasattr(os, "copy_file_range"), "needs copy_file_range")
+    def test_fast_copy_short(self) -> None:
+        real_copy_file_range = os.copy_file_range
+        calls = 0
+
+        def stop_early(src: int, dst: int, count: int) -> int:
+            # One real chunk, then a premature 0 like some filesystems give
+            nonlocal calls
+            calls += 1
+            return real_copy_file_range(src, dst, 1000) if calls == 1 else 0
+
+        with tempfile.TemporaryDirectory() as d:
+            src = Path(d, "src")
+            dst = Path(d, "dst")
+            src.write_bytes(os.urandom(100000))
+            with mock.patch("honesty.api.os.copy_file_range", stop_early):
+                _fast_copy(src, dst)
+            self.assertEqual(2, calls)
+            self.assertEqual(src.read_bytes(), dst.read_bytes())
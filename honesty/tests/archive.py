@@ -1,13 +1,26 @@
+import fnmatch
+import hashlib
 import os
 import os.path
 import shutil
+import tarfile
 import tempfile
 import unittest
 from pathlib import Path
 from typing import Dict
 from unittest import mock
 
-from ..archive import archive_hashes, extract_and_get_names
+from ..archive import (
+    _compile_patterns,
+    _hash_file,
+    _make_srckey,
+    _member_hashes,
+    _member_relname,
+    _unpack,
+    archive_hashes,
+    extract_and_get_names,
+    iter_members,
+)
 
 
 def create_test_archive(
@@ -99,6 +112,44 @@ class ArchiveTest(unittest.TestCase):
         finally:
             os.remove(archive)
 
+    def test_extract_ignores_legacy_dirs(self) -> None:
+        archive = create_test_archive({"foo-0.1/setup.py": "setup()\n"}, "whl", "zip")
+        try:
+            with tempfile.TemporaryDirectory() as d:
+                # An older version's interrupted extraction, with no .done
+                os.makedirs(os.path.join(d, archive.name, "foo-0.1"))
+                with mock.patch("honesty.archive.os.environ.get", return_value=d):
+                    archive_root, names = extract_and_get_names(archive)
+                self.assertEqual(
+                    [os.path.join("foo-0.1", "setup.py")], [n for n, _ in names]
+                )
+                self.assertNotEqual(os.path.join(d, archive.name), archive_root)
+        finally:
+            archive.unlink()
+
+    def test_unpack(self) -> None:
+        archive = create_test_archive(
+            {"foo-0.1/foo.py": "x = 1\n", "foo-0.1/a/b.py": "y = 2\n"},
+            "tar.gz",
+            "gztar",
+        )
+        try:
+            # Without external tools; with plain gzip standing in for pigz; and
+            # with one that fails, which falls back to tarfile.
+            for external in (None, ("tar", "gzip"), ("tar", "false")):
+                if external and not shutil.which("tar"):
+                    continue
+                with tempfile.TemporaryDirectory() as d, mock.patch(
+                    "honesty.archive._external_tar", return_value=external
+                ):
+                    _unpack(archive, d)
+                    self.assertEqual(
+                        "y = 2\n", Path(d, "foo-0.1", "a", "b.py").read_text()
+                    )
+                    self.assertEqual(["foo-0.1"], os.listdir(d))
+        finally:
+            os.remove(archive)
+
     def test_hashes(self) -> None:
         archive = create_test_archive(
             {
@@ -125,5 +176,186 @@ class ArchiveTest(unittest.TestCase):
                         hashes,
                     )
 
+                    extracted = extract_and_get_names(archive)
+                    self.assertEqual(
+                        hashes, archive_hashes(archive, extracted=extracted)
+                    )
+                    with mock.patch("honesty.archive.HASH_BATCH_SIZE", 1):
+                        self.assertEqual(
+                            hashes, archive_hashes(archive, extracted=extracted)
+                        )
+
+                    # Not remembered unless the file is known to have that
+                    # digest
+                    self.assertEqual(
+                        hashes, archive_hashes(archive, archive_sha256="abc")
+                    )
+                    self.assertEqual([], [*Path(d).glob("*.json")])
+
+                    # Remembered by archive digest; the second call doesn't
+                    # need to read the archive at all.
+                    with mock.patch(
+                        "honesty.archive.recorded_digest", return_value="abc"
+                    ):
+                        self.assertEqual(
+                            hashes, archive_hashes(archive, archive_sha256="abc")
+                        )
+                        with mock.patch(
+                            "honesty.archive.extract_and_get_names"
+                        ) as mock_extract, mock.patch(
+                            "honesty.archive._member_hashes"
+                        ) as mock_member_hashes:
+                            self.assertEqual(
+                                hashes, archive_hashes(archive, archive_sha256="abc")
+                            )
+                            mock_extract.assert_not_called()
+                            mock_member_hashes.assert_not_called()
+
         finally:
             os.remove(archive)
+
+    def test_member_hashes_match_extracted(self) -> None:
+        contents = {
+            "foo-0.1/setup.py": "setup()\r\n",
+            "foo-0.1/src/proj/__init__.py": "",
+            "foo-0.1/src/proj/data.txt": "x",
+            "foo-0.1/tests/test_foo.py": "assert True\n",
+        }
+        for extension, format in (("tar.gz", "gztar"), ("whl", "zip")):
+            archive = create_test_archive(contents, extension, format)
+            try:
+                with tempfile.TemporaryDirectory() as d:
+                    with mock.patch("honesty.archive.os.environ.get", return_value=d):
+                        for strip_top_level in (False, True):
+                            extracted = extract_and_get_names(archive, strip_top_level)
+                            expected = archive_hashes(archive, extracted=extracted)
+                            self.assertEqual(
+                                expected,
+                                _member_hashes(archive, strip_top_level, "sha1"),
+                            )
+                            with mock.patch("honesty.archive.HASH_BATCH_SIZE", 1):
+                                self.assertEqual(
+                                    expected,
+                                    _member_hashes(archive, strip_top_level, "sha1"),
+                                )
+            finally:
+                os.remove(archive)
+
+        self.assertIsNone(_member_hashes(Path("foo.rar"), False, "sha1"))
+        self.assertEqual(os.path.join("a", "b.py"), _member_relname("./a//b.py"))
+        self.assertIsNone(_member_relname("a/../../b.py"))
+        self.assertIsNone(_member_relname("/a.py"))
+
+    def test_iter_members(self) -> None:
+        contents = {
+            "foo-0.1/pyproject.toml": "[build-system]\n",
+            "foo-0.1/src/foo/__init__.py": "x = 1\n",
+            "foo-0.1/foo.so": "",
+        }
+        for extension, format in (("tar.gz", "gztar"), ("whl", "zip")):
+            archive = create_test_archive(contents, extension, format)
+            try:
+                with tempfile.TemporaryDirectory() as d:
+                    with mock.patch("honesty.archive.os.environ.get", return_value=d):
+                        for patterns in (("*.py", "*.toml"), ("*.so",)):
+                            archive_root, names = extract_and_get_names(
+                                archive, True, patterns
+                            )
+                            expected = {
+                                srcname: Path(archive_root, relname).read_bytes()
+                                for relname, srcname in names
+                            }
+                            self.assertEqual(
+                                expected,
+                                {
+                                    srcname: read()
+                                    for srcname, read in iter_members(
+                                        archive, True, patterns
+                                    )
+                                },
+                            )
+            finally:
+                os.remove(archive)
+
+    def test_iter_members_tar_links(self) -> None:
+        with tempfile.TemporaryDirectory() as src:
+            Path(src, "foo-0.1", "lib").mkdir(parents=True)
+            Path(src, "foo-0.1", "a.py").write_text("a = 1\n")
+            Path(src, "foo-0.1", "lib", "real.so").write_text("so")
+            Path(src, "foo-0.1", "z.py").write_text("z = 1\n")
+            os.symlink(os.path.join("lib", "real.so"), Path(src, "foo-0.1", "link.so"))
+            archive = Path(src, "foo-0.1.tar")
+            with tarfile.open(archive, "w") as tf:
+                for name in ("a.py", "lib/real.so", "link.so", "z.py"):
+                    tf.add(Path(src, "foo-0.1", name), f"foo-0.1/{name}")
+
+            with tempfile.TemporaryDirectory() as d:
+                with mock.patch("honesty.archive.os.environ.get", return_value=d):
+                    patterns = ("*.py", "*.so")
+                    archive_root, names = extract_and_get_names(archive, True, patterns)
+                    expected = {
+                        srcname: Path(archive_root, relname).read_bytes()
+                        for relname, srcname in names
+                    }
+                    self.assertIn("link.so", expected)
+                    members = [
+                        (srcname, read())
+                        for srcname, read in iter_members(archive, True, patterns)
+                    ]
+                    # The link is found through extraction, and nothing twice
+                    self.assertEqual(expected, dict(members))
+                    self.assertEqual(len(expected), len(members))
+
+    def test_make_srckey(self) -> None:
+        names = [
+            os.path.join("foo-0.1", "setup.py"),
+            os.path.join("foo-0.1", "src", "foo", "__init__.py"),
+            "toplevel.py",
+            os.path.join("other", "src", "x.py"),
+            os.path.join("foo-0.1", "foo.py"),
+            os.path.join("src", "y.py"),
+        ]
+        for strip_top_level in (False, True):
+            srckey = _make_srckey(strip_top_level)
+            for name in names:
+                expected = name.split(os.sep, 1)[-1] if strip_top_level else name
+                if expected.startswith("src" + os.sep):
+                    expected = expected[4:]
+                self.assertEqual(expected, srckey(name))
+
+    def test_compile_patterns(self) -> None:
+        names = [
+            "a.py",
+            "a.pyc",
+            "LICENSE",
+            "LICENSE.txt",
+            "x.so",
+            "pyproject.toml",
+            "setup.cfg",
+            "Setup.py",
+        ]
+        for patterns in (
+            ("*.py",),
+            ("LICENSE*", "COPY*"),
+            ("*.so", "*.dll"),
+            ("pyproject.toml",),
+            ("*.*",),
+            ("*.py", "setup.cfg", "[Ss]etup.py"),
+        ):
+            matches = _compile_patterns(patterns)
+            for name in names:
+                self.assertEqual(
+                    any(fnmatch.fnmatch(name, p) for p in patterns),
+                    matches(name),
+                    (patterns, name),
+                )
+
+    def test_hash_file_crlf_across_blocks(self) -> None:
+        data = b"a\r\nb\r\r\n\r\rc\r"
+        expected = hashlib.sha1(data.replace(b"\r\n", b"\n")).hexdigest()
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "f")
+            with open(path, "wb") as f:
+                f.write(data)
+            for block_size in (1, 2, 3, 1024):
+                self.assertEqual(expected, _hash_file(path, block_size))
@@ -1,4 +1,6 @@
 import asyncio
+import hashlib
+import json
 import os.path
 import posixpath
 import tempfile
@@ -7,7 +9,14 @@ from pathlib import Path
 from typing import Any, Dict, Optional, Tuple
 from unittest import mock
 
-from ..cache import Cache
+from ..cache import (
+    _uvloop,
+    atomic_writer,
+    Cache,
+    ChecksumMismatch,
+    new_event_loop,
+    run,
+)
 
 
 class AiohttpStreamMock:
@@ -15,13 +24,21 @@ class AiohttpStreamMock:
         self._content = content
 
     # TODO async iterable[bytes]
-    async def iter_any(self) -> Any:
-        yield self._content
+    async def iter_chunked(self, n: int) -> Any:
+        for i in range(0, len(self._content), n):
+            yield self._content[i : i + n]
 
 
 class AiohttpResponseMock:
-    def __init__(self, content: bytes) -> None:
+    def __init__(
+        self,
+        content: bytes,
+        status: int = 200,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
         self.content = AiohttpStreamMock(content)
+        self.status = status
+        self.headers = headers or {}
 
     async def __aenter__(self) -> "AiohttpResponseMock":
         return self
@@ -45,16 +62,27 @@ class FakeCache:
 
         return self.path / basename
 
-    async def async_fetch(self, package_name: str, url: Optional[str] = None) -> Path:
+    async def async_fetch(
+        self,
+        package_name: str,
+        url: Optional[str] = None,
+        revalidate: Optional[bool] = None,
+    ) -> Path:
         return self.fetch(package_name, url)
 
+    def get_digest(self, path: Path) -> Optional[str]:
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+
 
 class CacheTest(unittest.TestCase):
     def test_fetch_caches(self) -> None:
         d = tempfile.mkdtemp()
 
         def get_side_effect(
-            url: str, raise_for_status: bool = False, timeout: Any = None
+            url: str,
+            raise_for_status: bool = False,
+            timeout: Any = None,
+            headers: Optional[Dict[str, str]] = None,
         ) -> AiohttpResponseMock:
             if url == "https://example.com/other":
                 return AiohttpResponseMock(b"other")
@@ -86,6 +114,9 @@ class CacheTest(unittest.TestCase):
                     # TODO mock_get.assert_called_once()
                     with rv.open() as f:
                         self.assertEqual("foo", f.read())
+                    self.assertEqual(
+                        hashlib.sha256(b"foo").hexdigest(), cache.get_digest(rv)
+                    )
 
                     # Absolute path url support
                     rv = await cache.async_fetch(
@@ -99,8 +130,177 @@ class CacheTest(unittest.TestCase):
                     with rv.open() as f:
                         self.assertEqual("relpath", f.read())
 
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(inner())
+        asyncio.run(inner())
+
+    def test_fetch_checks_digest(self) -> None:
+        def get_side_effect(
+            url: str,
+            raise_for_status: bool = False,
+            timeout: Any = None,
+            headers: Optional[Dict[str, str]] = None,
+        ) -> AiohttpResponseMock:
+            return AiohttpResponseMock(b"foo")
+
+        async def inner(d: str) -> None:
+            async with Cache(
+                index_url="https://pypi.org/simple/", cache_dir=d
+            ) as cache:
+                with mock.patch.object(
+                    cache.session, "get", side_effect=get_side_effect
+                ):
+                    with self.assertRaises(ChecksumMismatch):
+                        await cache.async_fetch(
+                            "projectname", url="a-1.0.tar.gz", expected_sha256="0"
+                        )
+                    # Not published under the final name
+                    self.assertFalse(
+                        Path(d, "pr", "oj", "projectname", "a-1.0.tar.gz").exists()
+                    )
+                    rv = await cache.async_fetch(
+                        "projectname",
+                        url="a-1.0.tar.gz",
+                        expected_sha256=hashlib.sha256(b"foo").hexdigest(),
+                    )
+                    self.assertEqual(b"foo", rv.read_bytes())
+
+        with tempfile.TemporaryDirectory() as d:
+            asyncio.run(inner(d))
+
+    def test_fetch_fresh_index_revalidates(self) -> None:
+        d = tempfile.mkdtemp()
+        seen_headers = []
+
+        def get_side_effect(
+            url: str,
+            raise_for_status: bool = False,
+            timeout: Any = None,
+            headers: Optional[Dict[str, str]] = None,
+        ) -> AiohttpResponseMock:
+            seen_headers.append(headers)
+            if headers:
+                return AiohttpResponseMock(b"", status=304)
+            return AiohttpResponseMock(
+                b"foo",
+                headers={"etag": '"abc"', "last-modified": "Mon, 01 Jan 2024"},
+            )
+
+        async def inner() -> None:
+            async with Cache(
+                index_url="https://pypi.org/simple/", cache_dir=d, fresh_index=True
+            ) as cache:
+                with mock.patch.object(
+                    cache.session, "get", side_effect=get_side_effect
+                ):
+                    rv = await cache.async_fetch("projectname", url=None)
+                    rv = await cache.async_fetch("projectname", url=None)
+                    with rv.open() as f:
+                        self.assertEqual("foo", f.read())
+                    # A torn .hdrs means an unconditional fetch, not a crash
+                    rv.with_name(rv.name + ".hdrs").write_text("{")
+                    rv = await cache.async_fetch("projectname", url=None)
+
+        asyncio.run(inner())
+        self.assertEqual(
+            [
+                {},
+                {
+                    "If-None-Match": '"abc"',
+                    "If-Modified-Since": "Mon, 01 Jan 2024",
+                },
+                {},
+            ],
+            seen_headers,
+        )
+
+    def test_record_digest(self) -> None:
+        with tempfile.TemporaryDirectory() as d:
+            cache = Cache(cache_dir=d)
+            path = Path(d, "index.html")
+            path.write_bytes(b"foo")
+            self.assertIsNone(cache.get_digest(path))
+
+            path.with_name("index.html.hdrs").write_text('{"etag": "\\"abc\\""}')
+            digest = hashlib.sha256(b"foo").hexdigest()
+            self.assertEqual(digest, cache.record_digest(path))
+            self.assertEqual(digest, cache.get_digest(path))
+            hdrs = json.loads(path.with_name("index.html.hdrs").read_text())
+            self.assertEqual('"abc"', hdrs["etag"])
+
+    def test_fetch_revalidate_overrides_fresh_index(self) -> None:
+        seen_headers = []
+
+        def get_side_effect(
+            url: str,
+            raise_for_status: bool = False,
+            timeout: Any = None,
+            headers: Optional[Dict[str, str]] = None,
+        ) -> AiohttpResponseMock:
+            seen_headers.append(headers)
+            if headers:
+                return AiohttpResponseMock(b"", status=304)
+            return AiohttpResponseMock(b"foo", headers={"etag": '"abc"'})
+
+        async def inner(d: str) -> None:
+            async with Cache(
+                index_url="https://pypi.org/simple/", cache_dir=d
+            ) as cache:
+                with mock.patch.object(
+                    cache.session, "get", side_effect=get_side_effect
+                ):
+                    await cache.async_fetch("projectname", url=None)
+                    # Trusted as-is without fresh_index...
+                    await cache.async_fetch("projectname", url=None)
+                    # ...unless asked for this call.
+                    rv = await cache.async_fetch(
+                        "projectname", url=None, revalidate=True
+                    )
+                    self.assertEqual(b"foo", rv.read_bytes())
+
+        with tempfile.TemporaryDirectory() as d:
+            asyncio.run(inner(d))
+        self.assertEqual([{}, {"If-None-Match": '"abc"'}], seen_headers)
+
+    def test_run_sync_reuses_session(self) -> None:
+        async def get_session(cache: Cache) -> Any:
+            return cache.session
+
+        with tempfile.TemporaryDirectory() as d:
+            with Cache(cache_dir=d) as cache:
+                session = cache.run_sync(get_session(cache))
+                self.assertIs(session, cache.run_sync(get_session(cache)))
+                self.assertFalse(session.closed)
+            self.assertTrue(session.closed)
+
+            # A loop that's passed in is the caller's to close
+            loop = asyncio.new_event_loop()
+            try:
+                with Cache(cache_dir=d, loop=loop) as cache:
+                    session = cache.run_sync(get_session(cache))
+                self.assertTrue(session.closed)
+                self.assertFalse(loop.is_closed())
+            finally:
+                loop.close()
+
+    def test_atomic_writer(self) -> None:
+        with tempfile.TemporaryDirectory() as d:
+            p = Path(d, "f")
+            for contents in (b"one", b"two"):
+                with atomic_writer(p) as f:
+                    f.write(contents)
+                    if contents == b"two":
+                        self.assertEqual(b"one", p.read_bytes())
+                self.assertEqual(contents, p.read_bytes())
+            self.assertEqual(["f"], os.listdir(d))
+
+            # A failed write leaves neither a new file nor a temp one behind
+            for use_tmpfile in (True, False):
+                with mock.patch("honesty.cache._use_tmpfile", use_tmpfile):
+                    with self.assertRaises(ValueError):
+                        with atomic_writer(p) as f:
+                            f.write(b"three")
+                            raise ValueError()
+                self.assertEqual(b"two", p.read_bytes())
+                self.assertEqual(["f"], os.listdir(d))
 
     @mock.patch("honesty.cache.os.environ.get")
     def test_cache_env_vars(self, mock_get: Any) -> None:
@@ -125,6 +325,41 @@ class CacheTest(unittest.TestCase):
             self.assertTrue(cache._is_index_filename("json"))
             self.assertFalse(cache._is_index_filename("foo-0.1.tar.gz"))
 
+    def test_connection_limit_per_host(self) -> None:
+        from ..cache import CONNECTION_LIMIT_PER_HOST
+
+        self.assertEqual(
+            CONNECTION_LIMIT_PER_HOST, Cache().connection_limit_per_host
+        )
+        self.assertEqual(
+            2, Cache(connection_limit_per_host=2).connection_limit_per_host
+        )
+        self.assertEqual(
+            CONNECTION_LIMIT_PER_HOST,
+            Cache(connection_limit_per_host=1000).connection_limit_per_host,
+        )
+
+        async def inner() -> int:
+            async with Cache(connection_limit_per_host=3) as cache:
+                limit: int = cache.session.connector.limit_per_host  # type: ignore
+                return limit
+
+        self.assertEqual(3, asyncio.run(inner()))
+
+    def test_uvloop_opt_out(self) -> None:
+        async def answer() -> int:
+            return 42
+
+        with mock.patch.dict(os.environ, {"HONESTY_NO_UVLOOP": "1"}):
+            self.assertIsNone(_uvloop())
+            self.assertEqual(42, run(answer()))
+            loop = new_event_loop()
+            try:
+                self.assertNotIn("uvloop", type(loop).__module__)
+                self.assertEqual(42, loop.run_until_complete(answer()))
+            finally:
+                loop.close()
+
     def test_sync_cache_handles_redirects(self) -> None:
         filename = "honesty-0.2.1-py2.py3-none-any.whl"
         with tempfile.TemporaryDirectory() as d:
@@ -136,7 +371,9 @@ class CacheTest(unittest.TestCase):
                 )
                 self.assertEqual(15083, Path(rv).stat().st_size)
                 # For now, etag is always repr(md5(bytes))
+                hdrs = json.loads(Path(str(rv) + ".hdrs").read_text())
+                self.assertEqual('"09a55a3170d4cec331735c9edc2e8afb"', hdrs["etag"])
                 self.assertEqual(
-                    r'{"etag": "\"09a55a3170d4cec331735c9edc2e8afb\""}',
-                    Path(str(rv) + ".hdrs").read_text(),
+                    hashlib.sha256(Path(rv).read_bytes()).hexdigest(),
+                    cache.get_digest(rv),
                 )
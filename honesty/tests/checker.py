@@ -1,4 +1,9 @@
+import asyncio
+import os
+import tempfile
 import unittest
+from pathlib import Path
+from typing import Any, Awaitable, Dict, List, Optional, TypeVar
 from unittest import mock
 
 import click
@@ -7,8 +12,38 @@ from infer_license.types import License
 from packaging.version import Version
 
 from ..cache import Cache
-from ..checker import _version_helper, guess_license, has_nativemodules, is_pep517
+from ..checker import (
+    _version_helper,
+    guess_license,
+    has_nativemodules,
+    is_pep517,
+    prefetch_dists,
+    run_checker,
+)
 from ..releases import FileType, parse_index
+from .archive import create_test_archive
+from .helpers import make_file_entry, make_package, make_release
+
+T = TypeVar("T")
+
+
+class FakeCache:
+    def __init__(self, files: Dict[str, Path]) -> None:
+        self.files = files
+        self.fetched: List[str] = []
+
+    def run_sync(self, coro: Awaitable[T]) -> T:
+        async def _run() -> T:
+            return await coro
+
+        return asyncio.run(_run())
+
+    async def async_fetch(
+        self, pkg: str, url: Optional[str], expected_sha256: Optional[str] = None
+    ) -> Path:
+        assert url is not None
+        self.fetched.append(url)
+        return self.files[url]
 
 
 class CheckerTest(unittest.TestCase):
@@ -25,18 +60,46 @@ class CheckerTest(unittest.TestCase):
             _version_helper(pkg, Version("0.2.1"), c, FileType.BDIST_DMG, ("LICENSE",))
 
     def test_has_nativemodules(self) -> None:
-        with mock.patch(
-            "honesty.checker._version_helper",
-            return_value=("/foo", [("foo/x.bin", "x.bin")]),
+        with mock.patch("honesty.checker._fetch_dist"), mock.patch(
+            "honesty.checker.iter_members",
+            return_value=iter([("x.bin", None)]),
         ):
             self.assertFalse(has_nativemodules(mock.Mock(), None, False, None))  # type: ignore[arg-type]
 
-        with mock.patch(
-            "honesty.checker._version_helper",
-            return_value=("/foo", [("foo/x.so", "x.so")]),
+        with mock.patch("honesty.checker._fetch_dist"), mock.patch(
+            "honesty.checker.iter_members",
+            return_value=iter([("x.so", None)]),
         ):
             self.assertTrue(has_nativemodules(mock.Mock(), None, False, None))  # type: ignore[arg-type]
 
+    def test_guess_license(self) -> None:
+        names = [
+            ("foo/sub/LICENSE", "sub/LICENSE"),
+            ("foo/COPYING", "COPYING"),
+            ("foo/LICENSE.txt", "LICENSE.txt"),
+        ]
+        with mock.patch(
+            "honesty.checker._version_helper", return_value=("/x", names)
+        ), mock.patch("honesty.checker.guess_file", return_value=None) as m:
+            lic = guess_license(mock.Mock(), None, False, None)  # type: ignore[arg-type]
+            self.assertEqual("Present but unknown", lic)
+            m.assert_called_once_with(os.path.join("/x", "foo/COPYING"))
+
+        with mock.patch("honesty.checker._version_helper", return_value=("/x", [])):
+            self.assertIsNone(guess_license(mock.Mock(), None, False, None))  # type: ignore[arg-type]
+
+    def test_is_pep517(self) -> None:
+        for data, backend in (
+            (b'[build-system]\nbuild-backend = "flit_core.buildapi"\n', "flit_core"),
+            (b"[tool.black]\nline-length = 88\n", "?"),
+        ):
+            with mock.patch("honesty.checker._fetch_dist"), mock.patch(
+                "honesty.checker.iter_members",
+                return_value=iter([("pyproject.toml", lambda: data)]),
+            ), mock.patch("honesty.checker.click.echo") as echo:
+                self.assertTrue(is_pep517(mock.Mock(), None, False, None))  # type: ignore[arg-type]
+                self.assertIn(backend, echo.call_args[0][0])
+
     def test_has_nativemodules_live(self) -> None:
         # N.b. does not specify fresh_index, so this can reuse downloads
         c = Cache()
@@ -66,3 +129,72 @@ class CheckerTest(unittest.TestCase):
         self.assertFalse(is_pep517(pkg, Version("0.2.1"), False, c))
         pkg = parse_index("black", c)
         self.assertTrue(is_pep517(pkg, Version("23.9.1"), False, c))
+
+    def test_run_checker(self) -> None:
+        sdist = create_test_archive(
+            {"foo-0.1/foo.py": "x = 1\n", "foo-0.1/setup.py": "setup()\n"},
+            "tar.gz",
+            "gztar",
+        )
+        wheel = create_test_archive({"foo.py": "x = 2\n"}, "whl", "zip")
+        files = {"foo-0.1.tar.gz": sdist, "foo-0.1-py3-none-any.whl": wheel}
+        v = Version("0.1")
+        pkg = make_package(
+            "foo",
+            [
+                make_release(
+                    "0.1",
+                    [
+                        make_file_entry(name, checksum=f"sha256={i}")
+                        for i, name in enumerate(files)
+                    ],
+                )
+            ],
+        )
+        cache: Any = FakeCache(files)
+        digests = {sdist: "0", wheel: "1"}
+        try:
+            with tempfile.TemporaryDirectory() as d:
+                with mock.patch("honesty.archive.os.environ.get", return_value=d):
+                    # Files not known to match the index aren't remembered
+                    self.assertEqual(8, run_checker(pkg, v, False, cache))
+                    self.assertFalse(os.path.exists(os.path.join(d, "verdicts")))
+
+                    with mock.patch(
+                        "honesty.checker.recorded_digest", side_effect=digests.get
+                    ):
+                        self.assertEqual(8, run_checker(pkg, v, False, cache))
+                        # The verdict is remembered by archive digests
+                        with mock.patch("honesty.checker.archive_hashes") as m:
+                            self.assertEqual(8, run_checker(pkg, v, False, cache))
+                            m.assert_not_called()
+
+                    # ...and only used while the files still match them
+                    digests[wheel] = "2"
+                    with mock.patch(
+                        "honesty.checker.recorded_digest", side_effect=digests.get
+                    ), mock.patch(
+                        "honesty.checker._compare_hashes", return_value=(0, "")
+                    ):
+                        self.assertEqual(0, run_checker(pkg, v, False, cache))
+        finally:
+            os.remove(sdist)
+            os.remove(wheel)
+
+    def test_prefetch_dists(self) -> None:
+        v = Version("0.1")
+        names = ["foo-0.1-py3-none-any.whl", "foo-0.1.tar.gz", "foo-0.1.zip"]
+        pkg = make_package("foo", [make_release("0.1", map(make_file_entry, names))])
+        # Missing files and versions are left for the checks to report
+        cache: Any = FakeCache({names[0]: Path(names[0]), names[1]: Path(names[1])})
+        targets = [(pkg, v), (pkg, Version("0.2"))]
+
+        prefetch_dists(cache, targets, FileType.SDIST)
+        self.assertEqual(["foo-0.1.tar.gz"], cache.fetched)
+
+        cache.fetched.clear()
+        prefetch_dists(cache, targets, FileType.BDIST_DMG)
+        self.assertEqual([], cache.fetched)
+
+        prefetch_dists(cache, targets, None)
+        self.assertEqual(names, sorted(cache.fetched))
@@ -1,10 +1,44 @@
+import asyncio
+import datetime
 import hashlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
 from pathlib import Path
+from typing import Any, List
+from unittest import mock
 
+import aiohttp
+import click
 from click.testing import CliRunner
+from packaging.version import Version
 
-from ..cmdline import download, extract, license
+from ..cache import Cache
+from ..cmdline import (
+    _cli_loop,
+    _COPY_FUNCTIONS,
+    _expand_stdin,
+    _file_sha256,
+    _json_line,
+    _LOOP_KEY,
+    _make_cache,
+    _parse_indexes,
+    _shared_cache,
+    age,
+    cli,
+    dataclass_default,
+    download,
+    extract,
+    license,
+    select_versions,
+    wrap_async,
+)
+from ..releases import FileType, Package
+from .helpers import make_file_entry, make_package, make_release
 
 
 class DownloadTest(unittest.TestCase):
@@ -29,6 +63,118 @@ class ExtractTest(unittest.TestCase):
         result = runner.invoke(extract, ["honesty==0.2.1"])
         self.assertTrue(Path(result.output.strip(), "MANIFEST.in").exists())
 
+    def test_extract_prefers_sdist(self) -> None:
+        async def fake_parse_index(name: str, cache: Any, **kwargs: Any) -> Package:
+            files = map(make_file_entry, ("foo-1.0-py3-none-any.whl", "foo-1.0.tar.gz"))
+            return make_package(name, [make_release("1.0", files)])
+
+        fetched = []
+
+        async def fake_fetch(self: Any, pkg: str, url: str) -> Path:
+            fetched.append(url)
+            return Path(url)
+
+        with tempfile.TemporaryDirectory() as d:
+            Path(d, "foo-1.0").mkdir()
+            with mock.patch("honesty.releases.async_parse_index", fake_parse_index):
+                with mock.patch.object(Cache, "async_fetch", fake_fetch):
+                    with mock.patch(
+                        "honesty.archive.extract_and_get_names", return_value=(d, [])
+                    ):
+                        result = CliRunner().invoke(extract, ["foo==1.0"])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual(["foo-1.0.tar.gz"], fetched)
+        self.assertEqual(os.path.join(d, "foo-1.0") + "\n", result.output)
+
+    def test_extract_dest_counts_stdin_names(self) -> None:
+        with tempfile.TemporaryDirectory() as d:
+            result = CliRunner().invoke(extract, ["--dest", d, "-"], input="foo bar\n")
+        self.assertEqual(1, result.exit_code)
+        self.assertIn("Cannot specify dest", result.output)
+
+
+class FileSha256Test(unittest.TestCase):
+    def test_file_sha256(self) -> None:
+        data = os.urandom(100000)
+        expected = hashlib.sha256(data).hexdigest()
+        with tempfile.TemporaryDirectory() as d:
+            path = Path(d, "f")
+            path.write_bytes(data)
+            self.assertEqual(expected, _file_sha256(path))
+            # The readinto loop, with a buffer smaller than the file
+            with mock.patch.object(sys, "version_info", (3, 10)), mock.patch(
+                "honesty.cmdline.BUFFER_SIZE", 4096
+            ):
+                self.assertEqual(expected, _file_sha256(path))
+
+
+class ReuseSessionTest(unittest.TestCase):
+    def test_reuse_session(self) -> None:
+        @wrap_async
+        async def async_session() -> Any:
+            async with _make_cache() as cache:
+                return cache.session
+
+        async def get_session(cache: Cache) -> Any:
+            return cache.session
+
+        with tempfile.TemporaryDirectory() as d, click.Context(cli):
+            with mock.patch.dict(os.environ, {"HONESTY_CACHE": d}):
+                session = async_session()
+                self.assertTrue(session.closed)
+                self.assertIsNot(session, async_session())
+
+            with mock.patch.dict(
+                os.environ, {"HONESTY_CACHE": d, "HONESTY_REUSE_SESSION": "1"}
+            ):
+                session = async_session()
+                self.assertIs(session, async_session())
+                # Sync commands share it too
+                with _make_cache() as cache:
+                    self.assertIs(session, cache.run_sync(get_session(cache)))
+                self.assertFalse(session.closed)
+
+                # What atexit would do
+                cache.__exit__(None, None, None)
+                _shared_cache.cache_clear()
+                self.assertTrue(session.closed)
+
+    def test_cli_loop(self) -> None:
+        @wrap_async
+        async def running_loop() -> Any:
+            return asyncio.get_running_loop()
+
+        async def get_loop() -> Any:
+            return asyncio.get_running_loop()
+
+        with tempfile.TemporaryDirectory() as d, click.Context(cli) as ctx:
+            with mock.patch.dict(os.environ, {"HONESTY_CACHE": d}):
+                with _cli_loop() as loop:
+                    ctx.meta[_LOOP_KEY] = loop
+                    self.assertIs(loop, running_loop())
+                    with _make_cache() as cache:
+                        self.assertIs(loop, cache.run_sync(get_loop()))
+                    # The command's Cache leaves it for the next user
+                    self.assertFalse(loop.is_closed())
+                    self.assertIs(loop, running_loop())
+                self.assertTrue(loop.is_closed())
+
+
+class CopyModeTest(unittest.TestCase):
+    def test_copy_functions(self) -> None:
+        with tempfile.TemporaryDirectory() as d:
+            src = Path(d, "src")
+            src.write_bytes(b"x" * 1000)
+            src.chmod(0o755)
+            for mode, fn in _COPY_FUNCTIONS.items():
+                dst = Path(d, mode)
+                fn(str(src), str(dst))
+                self.assertEqual(src.read_bytes(), dst.read_bytes())
+                self.assertEqual(0o755, dst.stat().st_mode & 0o777)
+                self.assertEqual(
+                    mode == "link", os.path.samefile(src, dst), f"mode {mode}"
+                )
+
 
 class LicenseTest(unittest.TestCase):
     def test_honesty_license(self) -> None:
@@ -36,3 +182,219 @@ class LicenseTest(unittest.TestCase):
         result = runner.invoke(license, ["honesty==0.2.1"])
         self.assertEqual("honesty==0.2.1: MIT\n", result.output)
         self.assertEqual(0, result.exit_code)
+
+
+class ParseIndexesTest(unittest.TestCase):
+    def test_parse_indexes(self) -> None:
+        async def fake_parse_index(name: str, cache: Any, **kwargs: Any) -> Package:
+            if name == "missing":
+                raise aiohttp.ClientResponseError(None, (), status=404)  # type: ignore
+            return Package(name=name, releases={})
+
+        with tempfile.TemporaryDirectory() as d:
+            with Cache(cache_dir=d) as cache, mock.patch(
+                "honesty.releases.async_parse_index", fake_parse_index
+            ):
+                packages, rc = _parse_indexes(
+                    cache, ["foo==1.0", "missing", "bar"], use_json=True, concurrency=1
+                )
+        self.assertEqual(2, rc)
+        self.assertEqual(
+            [
+                ("foo", "==", "1.0", Package(name="foo", releases={})),
+                ("bar", "", "", Package(name="bar", releases={})),
+            ],
+            packages,
+        )
+
+    def test_parse_indexes_fetches_each_name_once(self) -> None:
+        fetched: List[str] = []
+
+        async def fake_parse_index(name: str, cache: Any, **kwargs: Any) -> Package:
+            fetched.append(name)
+            return Package(name=name, releases={})
+
+        with tempfile.TemporaryDirectory() as d:
+            with Cache(cache_dir=d) as cache, mock.patch(
+                "honesty.releases.async_parse_index", fake_parse_index
+            ):
+                packages, rc = _parse_indexes(
+                    cache, ["foo==1.0", "bar", "foo==2.0"], use_json=True
+                )
+        self.assertEqual(0, rc)
+        self.assertEqual(["foo", "bar"], fetched)
+        self.assertEqual(
+            [("foo", "1.0"), ("bar", ""), ("foo", "2.0")],
+            [(name, version) for name, _, version, _ in packages],
+        )
+
+    def test_expand_stdin(self) -> None:
+        self.assertEqual(["a", "b"], _expand_stdin(["a", "b"]))
+        with mock.patch("sys.stdin", io.StringIO("b==1.0\nc\n\n d\n")):
+            self.assertEqual(["a", "b==1.0", "c", "d"], _expand_stdin(["a", "-"]))
+
+
+class AgeTest(unittest.TestCase):
+    def test_age(self) -> None:
+        times = {
+            "1.0": datetime.datetime(2020, 1, 1, 12, tzinfo=datetime.timezone.utc),
+            "1.1": None,
+            "1.2": datetime.datetime(2020, 1, 6, tzinfo=datetime.timezone.utc),
+        }
+
+        async def fake_parse_index(name: str, cache: Any, **kwargs: Any) -> Package:
+            return make_package(
+                name,
+                [
+                    make_release(
+                        v,
+                        [make_file_entry(f"{name}-{v}.tar.gz", upload_time=t)],
+                        yanked="oops" if v == "1.2" else None,
+                    )
+                    for v, t in times.items()
+                ],
+            )
+
+        runner = CliRunner()
+        with mock.patch("honesty.releases.async_parse_index", fake_parse_index):
+            result = runner.invoke(age, ["--base", "2020-01-11", "foo==*"])
+            yanked_result = runner.invoke(age, ["--base", "2020-01-11", "foo==1.2"])
+        self.assertEqual(0, result.exit_code)
+        self.assertEqual(
+            "1.0\t2020-01-01\t9.50\n1.1\t(no files)\t(no files)\n", result.output
+        )
+        self.assertEqual("1.2\t2020-01-06\t5.00\t(yanked)\n", yanked_result.output)
+
+    def test_age_base_is_a_date(self) -> None:
+        runner = CliRunner()
+        for base in ("2020-01-11T00:00+05:00", "20200111", "2020-W02-6", "2020-02-30"):
+            result = runner.invoke(age, ["--base", base, "foo"])
+            self.assertEqual(2, result.exit_code, base)
+            self.assertIn("--base", result.output)
+
+    def test_age_many(self) -> None:
+        async def fake_parse_index(name: str, cache: Any, **kwargs: Any) -> Package:
+            if name == "missing":
+                raise aiohttp.ClientResponseError(None, (), status=404)  # type: ignore
+            t = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+            fe = make_file_entry(f"{name}-1.0.zip", upload_time=t)
+            return make_package(name, [make_release("1.0", [fe])])
+
+        runner = CliRunner()
+        with mock.patch("honesty.releases.async_parse_index", fake_parse_index):
+            result = runner.invoke(
+                age, ["--base", "2020-01-02", "foo", "missing", "bar==1.0"]
+            )
+            # stdin is only read once, so a `-` in it is just a name
+            stdin_result = runner.invoke(
+                age, ["--base", "2020-01-02", "-"], input="foo -\n"
+            )
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("foo==1.0\t2020-01-01\t1.00\n", result.output)
+        self.assertIn("bar==1.0\t2020-01-01\t1.00\n", result.output)
+        self.assertIn("Error: missing", result.output)
+        self.assertEqual(
+            "foo==1.0\t2020-01-01\t1.00\n-==1.0\t2020-01-01\t1.00\n",
+            stdin_result.output,
+        )
+
+
+class ListTest(unittest.TestCase):
+    def test_list(self) -> None:
+        async def fake_parse_index(name: str, cache: Any, **kwargs: Any) -> Package:
+            return make_package(
+                name,
+                [
+                    make_release(
+                        "1.0",
+                        [
+                            make_file_entry("foo-1.0.tar.gz"),
+                            make_file_entry(
+                                "foo-1.0-py3-none-any.whl", requires_python=">=3.8"
+                            ),
+                        ],
+                    ),
+                    make_release("2.0"),
+                ],
+            )
+
+        runner = CliRunner()
+        with mock.patch("honesty.cmdline.async_parse_index", fake_parse_index):
+            result = runner.invoke(cli, ["list", "foo"])
+        self.assertEqual(0, result.exit_code)
+        self.assertEqual(
+            "package foo\n"
+            "releases:\n"
+            "  1.0:\n"
+            "    foo-1.0.tar.gz\n"
+            "    foo-1.0-py3-none-any.whl (requires_python >=3.8)\n"
+            "  2.0:\n",
+            result.output,
+        )
+
+
+class ImportTest(unittest.TestCase):
+    def test_heavy_modules_are_lazy(self) -> None:
+        # Needs a fresh interpreter, since this test package imports them all.
+        out = subprocess.check_output(
+            [
+                sys.executable,
+                "-c",
+                "import sys, honesty.cmdline; "
+                "print(sorted(m for m in sys.modules if m.startswith('honesty.')))",
+            ],
+            encoding="utf-8",
+        )
+        for name in ("archive", "checker", "deps", "vcs"):
+            self.assertNotIn(f"'honesty.{name}'", out)
+        self.assertIn("'honesty.cmdline'", out)
+
+
+class SelectVersionsTest(unittest.TestCase):
+    def test_select_versions(self) -> None:
+        pkg = make_package(
+            "foo",
+            [
+                make_release(v, yanked=yanked)
+                for v, yanked in (("1.0", None), ("1.1", None), ("2.0", "oops"))
+            ],
+        )
+
+        self.assertEqual([Version("1.1")], select_versions(pkg, "", ""))
+        self.assertEqual(
+            [Version("1.0"), Version("1.1")], select_versions(pkg, "==", "*")
+        )
+        self.assertEqual([Version("2.0")], select_versions(pkg, "==", "2.0"))
+        with self.assertRaises(click.ClickException):
+            select_versions(pkg, "==", "3.0")
+
+        # unyanked_versions is remembered, so this needs a new Package
+        pkg = make_package(
+            "foo", [make_release(v, yanked="oops") for v in ("1.0", "1.1", "2.0")]
+        )
+        with self.assertRaises(click.ClickException):
+            select_versions(pkg, "", "")
+
+
+class DataclassDefaultTest(unittest.TestCase):
+    def test_dataclass_default(self) -> None:
+        fe = make_file_entry(
+            "foo-1.0.tar.gz",
+            upload_time=datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+        )
+        rel = make_release("1.0", [fe])
+        obj = json.loads(json.dumps(rel, default=dataclass_default))
+        self.assertEqual("1.0", obj["parsed_version"])
+        # IntEnum is an int as far as json is concerned, so default never sees it
+        self.assertEqual(FileType.SDIST.value, obj["files"][0]["file_type"])
+        self.assertEqual("2020-01-01 00:00:00+00:00", obj["files"][0]["upload_time"])
+        with self.assertRaises(TypeError):
+            dataclass_default(object())
+
+        # Same thing whether or not orjson is around, and cached properties
+        # aren't included.
+        self.assertIsNotNone(rel.earliest_upload)
+        line = _json_line(rel)
+        with mock.patch("honesty.cmdline.orjson", None):
+            self.assertEqual(json.loads(line), json.loads(_json_line(rel)))
+        self.assertEqual(json.dumps(obj, sort_keys=True), json.dumps(json.loads(line)))
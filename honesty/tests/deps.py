@@ -2,14 +2,17 @@ import io
 import sys
 import unittest
 from typing import Any
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 from packaging.specifiers import InvalidSpecifier, SpecifierSet
 from packaging.version import Version
 
 from ..deps import (
     _find_compatible_version,
+    _python_matches,
     convert_sdist_requires,
+    DepEdge,
+    DepNode,
     DepWalker,
     EnvironmentMarkers,
     print_deps,
@@ -100,6 +103,15 @@ class FindCompatibleVersionTest(unittest.TestCase):
         v = _find_compatible_version(FOO_PACKAGE, SpecifierSet(""), four)
         self.assertEqual(v1, v)
 
+    def test_requires_python_remembered(self) -> None:
+        four = Version("4.0.0")
+        _python_matches.cache_clear()
+        for _ in range(2):
+            v = _find_compatible_version(FOO_PACKAGE, SpecifierSet(""), four)
+            self.assertEqual(v1, v)
+        self.assertEqual(1, _python_matches.cache_info().misses)
+        self.assertEqual(1, _python_matches.cache_info().hits)
+
     def test_respect_already_chosen(self) -> None:
         three = Version("3.7.5")
         # This returns v1 with no already_chosen
@@ -200,6 +212,33 @@ class DepWalkerTest(unittest.TestCase):
         self.assertEqual("c", child.deps[0].target.deps[0].target.name)
         self.assertEqual(0, len(child.deps[0].target.deps[0].target.deps))
 
+    def test_walk_uses_given_cache(self) -> None:
+        cache = Mock()
+        with patch("honesty.deps.parse_index") as parse_mock, patch.object(
+            DepWalker, "_fetch_single_deps", return_value=[]
+        ) as fetch_mock:
+            parse_mock.return_value = C_PACKAGE
+            d = DepWalker("3.6.0", cache=cache)
+            d.enqueue(["c"])
+            d.walk(include_extras=False)
+        self.assertIs(cache, parse_mock.call_args[0][1])
+        self.assertIs(cache, fetch_mock.call_args[0][2])
+
+    def test_prefetch(self) -> None:
+        with patch("honesty.deps.parse_index") as parse_mock:
+            parse_mock.return_value = C_PACKAGE
+            d = DepWalker("3.6.0")
+            d.prefetch(["C", "c"])
+            self.assertEqual(["c"], list(d.futures))
+            self.assertEqual(C_PACKAGE, d.futures["c"].result())
+            self.assertEqual([], d.queue)
+
+            # enqueue reuses the same future
+            fut = d.futures["c"]
+            d.enqueue(["c"])
+            self.assertIs(fut, d.queue[0][2])
+        parse_mock.assert_called_once()
+
     @patch("honesty.deps.read_metadata_sdist")
     @patch("honesty.deps.read_metadata_remote_wheel")
     @patch("honesty.deps.read_metadata_wheel")
@@ -221,6 +260,28 @@ class PrintDepsTest(unittest.TestCase):
 a (==1.0) via * no whl
 . b (==1.0) via ==1.0 no whl
 . . c (==1.1) via * no whl
+""",
+            sys.stdout.getvalue(),  # type: ignore
+        )
+
+    @patch("sys.stdout", io.StringIO())
+    def test_already_listed(self) -> None:
+        c = DepNode("c", Version("1.0"), has_sdist=True, has_bdist=True)
+        tree = DepNode(
+            "fake",
+            Version("0"),
+            [
+                DepEdge(DepNode("a", Version("1.0"), [DepEdge(c)], has_sdist=True)),
+                DepEdge(DepNode("b", Version("1.0"), [DepEdge(c)], has_sdist=True)),
+            ],
+        )
+        print_deps(tree, set(), set())
+        self.assertEqual(
+            """\
+a (==1.0) via * no whl
+. c (==1.0) via *
+b (==1.0) via * no whl
+. c (==1.0) (already listed) via *
 """,
             sys.stdout.getvalue(),  # type: ignore
         )
@@ -0,0 +1,41 @@
+"""
+Builders for the Package structures that tests need, without going through an
+index.
+"""
+
+from typing import Any, Iterable
+
+from packaging.version import Version
+
+from ..releases import (
+    FileEntry,
+    guess_file_type,
+    guess_version,
+    Package,
+    PackageRelease,
+)
+
+
+def make_file_entry(basename: str, **kwargs: Any) -> FileEntry:
+    """
+    A FileEntry for basename (which is also its url), with file_type and
+    version guessed from it the way the index parsers do.  Any field can be
+    given to override that.
+    """
+    kwargs.setdefault("url", basename)
+    kwargs.setdefault("checksum", "sha256=0")
+    kwargs.setdefault("file_type", guess_file_type(basename))
+    kwargs.setdefault("version", guess_version(basename)[1])
+    return FileEntry(basename=basename, **kwargs)
+
+
+def make_release(
+    version: str, files: Iterable[FileEntry] = (), **kwargs: Any
+) -> PackageRelease:
+    return PackageRelease(
+        version=version, parsed_version=Version(version), files=[*files], **kwargs
+    )
+
+
+def make_package(name: str, releases: Iterable[PackageRelease]) -> Package:
+    return Package(name=name, releases={r.parsed_version: r for r in releases})
@@ -1,20 +1,28 @@
+import asyncio
 import datetime
 import json
 import re
 import tempfile
 import unittest
+from pathlib import Path
+from unittest import mock
 
-from packaging.version import Version
+from packaging.version import InvalidVersion, Version
 
 from ..releases import (
+    _parse_version,
+    async_parse_indexes,
     FileType,
     guess_file_type,
     guess_version,
+    Package,
+    PackageRelease,
     parse_index,
     parse_time,
     UnexpectedFilename,
 )
 from .cache import FakeCache
+from .helpers import make_file_entry, make_package, make_release
 
 WOAH_INDEX_CONTENTS = b"""\
 <!DOCTYPE html>
@@ -132,6 +140,46 @@ class ReleasesTest(unittest.TestCase):
         self.assertEqual(">=3.6", v01.files[0].requires_python)
         self.assertEqual(None, v01.files[0].upload_time)
 
+    def test_parsed_index_is_remembered(self) -> None:
+        with tempfile.TemporaryDirectory() as d:
+            c = FakeCache(d, {("woah", None): WOAH_INDEX_CONTENTS})
+            pkg = parse_index("woah", c)  # type: ignore
+            with mock.patch("honesty.releases._load_html") as m:
+                self.assertEqual(pkg, parse_index("woah", c))  # type: ignore
+                m.assert_not_called()
+
+            # A changed index is parsed again
+            c.url_to_contents[("woah", None)] = WOAH_INDEX_CONTENTS.replace(
+                b"woah-0.1", b"woah-0.3"
+            )
+            pkg = parse_index("woah", c)  # type: ignore
+            self.assertIn(Version("0.3"), pkg.releases)
+
+    def test_parsed_index_round_trips(self) -> None:
+        with tempfile.TemporaryDirectory() as d:
+            c = FakeCache(
+                d, {("woah", "https://pypi.org/pypi/woah/json"): WOAH_JSON_CONTENTS}
+            )
+            pkg = parse_index("woah", c, use_json=True)  # type: ignore
+            with mock.patch("honesty.releases._load_json") as m:
+                self.assertEqual(pkg, parse_index("woah", c, use_json=True))  # type: ignore
+                m.assert_not_called()
+
+            # A torn file is just parsed again
+            [parsed_path] = Path(d).glob("*.parsed-*")
+            parsed_path.write_bytes(b"{")
+            self.assertEqual(pkg, parse_index("woah", c, use_json=True))  # type: ignore
+
+    def test_async_parse_indexes(self) -> None:
+        with tempfile.TemporaryDirectory() as d:
+            c = FakeCache(d, {("woah", None): WOAH_INDEX_CONTENTS})
+            woah, missing = asyncio.run(
+                async_parse_indexes(["woah", "missing"], c, concurrency=1)  # type: ignore
+            )
+        assert isinstance(woah, Package)
+        self.assertEqual([Version("0.1"), Version("0.2")], [*woah.releases])
+        self.assertIsInstance(missing, KeyError)
+
     def test_get_entries_json(self) -> None:
         with tempfile.TemporaryDirectory() as d:
             c = FakeCache(
@@ -235,6 +283,53 @@ class ReleasesTest(unittest.TestCase):
             ("simplejson", "3.12.0"), guess_version("simplejson-3.12.0.win32.exe")
         )
 
+    def test_unyanked_versions(self) -> None:
+        pkg = make_package(
+            "foo",
+            [
+                make_release(v, yanked=yanked)
+                for v, yanked in (("0.9", None), ("0.10", "broken"), ("0.20", None))
+            ],
+        )
+        self.assertEqual((Version("0.9"), Version("0.20")), pkg.unyanked_versions)
+        self.assertIs(pkg.unyanked_versions, pkg.unyanked_versions)
+
+    def test_earliest_upload(self) -> None:
+        with tempfile.TemporaryDirectory() as d:
+            c = FakeCache(
+                d, {("woah", "https://pypi.org/pypi/woah/json"): WOAH_JSON_CONTENTS}
+            )
+            pkg = parse_index("woah", c, use_json=True)  # type: ignore
+
+        rel = pkg.releases[Version("0.1")]
+        self.assertEqual(
+            datetime.datetime(
+                2019, 9, 19, 14, 32, 17, 358350, tzinfo=datetime.timezone.utc
+            ),
+            rel.earliest_upload,
+        )
+        self.assertIsNone(PackageRelease("0.1", Version("0.1"), []).earliest_upload)
+
+    def test_file_type_partitions(self) -> None:
+        files = [
+            make_file_entry("foo-0.1-py3-none-any.whl"),
+            make_file_entry("foo-0.1.tar.gz"),
+            make_file_entry("foo-0.1-py3.7.egg"),
+            make_file_entry("foo-0.1.zip"),
+        ]
+        rel = make_release("0.1", files)
+        self.assertEqual((files[1], files[3]), rel.sdists)
+        self.assertEqual((files[0],), rel.wheels)
+        self.assertEqual((files[2],), rel.other)
+        self.assertIs(rel.sdists, rel.sdists)
+
+    def test_parse_version(self) -> None:
+        v = _parse_version("1.0")
+        self.assertEqual(Version("1.0"), v)
+        self.assertIs(v, _parse_version("1.0"))
+        with self.assertRaises(InvalidVersion):
+            _parse_version("not a version")
+
     def test_guess_file_type(self) -> None:
         expected = [
             ("foo-0.1", FileType.UNKNOWN),
@@ -281,3 +376,11 @@ class ReleasesTest(unittest.TestCase):
             ),
             v,
         )
+
+        v = parse_time("2019-09-19T14:32:17.1234567Z")
+        self.assertEqual(
+            datetime.datetime(
+                2019, 9, 19, 14, 32, 17, 123456, tzinfo=datetime.timezone.utc
+            ),
+            v,
+        )